@@ -3,26 +3,102 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-import pickle
+from math import ceil
 from typing import Optional, Tuple
 
 import numpy as np
 import torch
 from easyfsl.datasets import WrapFewShotDataset
 from easyfsl.methods import FewShotClassifier
-from easyfsl.samplers import TaskSampler
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from embedding_cache import cached_features
+from episode_loader import (TrimmedCollate, concat_pad_token_id, episode_pad_token_id, group_episodes,
+                            make_task_sampler, pad_to_width)
 from fsl_text_dataset import FewShotTextDataset
 
 logger = logging.getLogger(__name__)
+
+
+def mixed_precision(device, enabled):
+    """
+    enabled 为 True 时返回 bfloat16 autocast 上下文（--bf16）：backbone 和 FEAT 的矩阵乘法以 bfloat16 计算，
+    权重（以及优化器更新的主权重）仍为 float32，layer_norm、softmax 等由 autocast 保持 float32。
+    enabled 为 False 时什么也不做。
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def episode_scores(model, support_images, support_labels, query_images, fused=False, pad_token_id=None):
+    """
+    返回一个 episode 中查询集的分类得分。
+    fused 为 False 时与原来相同：先 process_support_set(支持集) 再 model(查询集)，backbone 运行两次。
+    fused 为 True 时把支持集和查询集拼接后只运行一次 backbone（批更大、CPU 利用率更高），
+    再把嵌入拆开，在 backbone 替换为 nn.Identity 的 FEAT 上完成同样的两步，结果相同（--fused_episodes）。
+
+    参数:
+        model: FEAT 模型。
+        support_images, support_labels, query_images: episode 中的支持集、支持集标签和查询集。
+        fused (bool): 是否只运行一次 backbone。
+        pad_token_id (int): 支持集和查询集分别裁剪过填充时，用于补齐到相同宽度（见 concat_pad_token_id），否则为 None。
+    """
+    if not fused:
+        model.process_support_set(support_images, support_labels)
+        return model(query_images)
+    support_images, query_images = pad_to_width([support_images, query_images], pad_token_id)
+    features = model.backbone(torch.cat([support_images, query_images]))
+    n_support = support_images.shape[0]
+    with cached_features(model):
+        model.process_support_set(features[:n_support], support_labels)
+        return model(features[n_support:])
+
+
+def batched_episode_scores(model, episodes, fused=False, pad_token_id=None):
+    """
+    返回多个 episode 中查询集的分类得分，按 episode 顺序拼接，形状为 (查询总数, n_way)。
+    所有 episode 的支持集和查询集拼接后只运行一次 backbone，之后按 (B, ...) 的布局
+    为每个 episode 分别计算原型、FEAT 注意力和到原型的距离（--train_batch_size / --eval_batch_size）。
+    只有一个 episode 时与 episode_scores 相同。
+
+    参数:
+        model: FEAT 模型。
+        episodes (list): (支持集, 支持集标签, 查询集) 的列表，各 episode 的 n_way、n_shot、n_query 相同。
+        fused (bool): 只有一个 episode 时传给 episode_scores。
+        pad_token_id (int): 各 episode 分别裁剪过填充时，用于补齐到相同宽度（见 concat_pad_token_id），否则为 None。
+    """
+    if len(episodes) == 1:
+        support_images, support_labels, query_images = episodes[0]
+        return episode_scores(model, support_images, support_labels, query_images,
+                              fused=fused, pad_token_id=pad_token_id)
+    n_episodes = len(episodes)
+    n_support, n_query = episodes[0][0].shape[0], episodes[0][2].shape[0]
+    images = pad_to_width([episode[0] for episode in episodes] + [episode[2] for episode in episodes], pad_token_id)
+    # 与 FEAT.compute_features 相同：backbone 之后做中心化和归一化
+    features = model.backbone(torch.cat(images))
+    with cached_features(model):
+        features = model.compute_features(features)
+    support_features = features[:n_episodes * n_support].reshape(n_episodes, n_support, -1)
+    query_features = features[n_episodes * n_support:].reshape(n_episodes, n_query, -1)
+
+    # 每个 episode 的原型为各类支持集嵌入的均值，形状为 (B, n_way, feature_dimension)
+    support_labels = torch.stack([episode[1] for episode in episodes])
+    n_way = int(support_labels.max()) + 1
+    one_hot = torch.nn.functional.one_hot(support_labels, n_way).transpose(1, 2).to(support_features.dtype)
+    prototypes = one_hot @ support_features / one_hot.sum(dim=2, keepdim=True)
+    prototypes = model.attention_module(prototypes, prototypes, prototypes)[0]
+    scores = -torch.cdist(query_features, prototypes)
+    return model.softmax_if_specified(scores).reshape(n_episodes * n_query, n_way)
+
+
 def evaluate_one_task(
         model: FewShotClassifier,
         support_images: torch.Tensor,
         support_labels: torch.Tensor,
         query_images: torch.Tensor,
         query_labels: torch.Tensor,
+        fused: bool = False,
+        pad_token_id: Optional[int] = None,
 ) -> Tuple[int, int]:
     """
     返回查询标签的正确预测数量和总预测数量。
@@ -32,13 +108,21 @@ def evaluate_one_task(
     :param support_labels: 支持集标签，形状为 (n_support,)
     :param query_images: 查询集图像，形状为 (n_query, 256)
     :param query_labels: 查询集标签，形状为 (n_query,)
+    :param fused: 支持集和查询集是否只运行一次 backbone（见 episode_scores）
+    :param pad_token_id: 填充 token 的 id
     :return: 正确预测数量和总预测数量
     """
-    # 处理支持集
-    model.process_support_set(support_images, support_labels)
+    return evaluate_episodes(model, [(support_images, support_labels, query_images)], query_labels,
+                             fused=fused, pad_token_id=pad_token_id)
+
 
-    # 获取查询集的预测结果
-    predictions = model(query_images).detach()
+def evaluate_episodes(model, episodes, query_labels, fused=False, pad_token_id=None):
+    """
+    返回一组 episode（见 batched_episode_scores）中查询标签的正确预测数量和总预测数量。
+    query_labels 为各 episode 的查询集标签按顺序拼接的结果。
+    """
+    # 处理支持集并获取查询集的预测结果
+    predictions = batched_episode_scores(model, episodes, fused=fused, pad_token_id=pad_token_id).detach()
 
     # 计算正确预测的数量
     number_of_correct_predictions = (
@@ -48,28 +132,28 @@ def evaluate_one_task(
     # 返回正确预测的数量和查询集的总数量
     return number_of_correct_predictions, query_labels.size(0)
 
-def evaluate(args, model, tokenizer,round_turn,time,tqdm_prefix: Optional[str] = None):
-
-    if not args.isLocal :
+def evaluate(args, model, tokenizer,round_turn,time,tqdm_prefix: Optional[str] = None,
+             eval_dataset=None, episode_pipeline=None):
+    """
+    在验证集上评估。训练时可传入已构建的 eval_dataset 和常驻的 episode_pipeline（其中注册了 'valid' 数据集），
+    避免每个 epoch 重新构建数据集和 DataLoader worker。
+    """
+    if eval_dataset is None:
+        # 数据集缓存未过期时直接加载，否则重新构建并写入缓存
         easy_eval_dataset = FewShotTextDataset(tokenizer, args, args.eval_data_file)
         eval_dataset = WrapFewShotDataset(easy_eval_dataset)
-        with open(f'../data{time}/pkl/valid_dataset{round_turn}.pkl', 'wb') as f:
-            pickle.dump(eval_dataset, f)
-    else:
-        with open(f'../data{time}/pkl/valid_dataset{round_turn}.pkl', 'rb') as f:
-            eval_dataset = pickle.load(f)
 
-    eval_sampler = TaskSampler(
-        eval_dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query, n_tasks=args.n_valid_per_epoch
-    )
-    n_workers = 4
-    eval_loader = DataLoader(
-        eval_dataset,
-        batch_sampler=eval_sampler,
-        num_workers=n_workers,
-        pin_memory=True,
-        collate_fn=eval_sampler.episodic_collate_fn,
-    )
+    eval_sampler = make_task_sampler(args, eval_dataset, n_tasks=args.n_valid_per_epoch)
+    if episode_pipeline is not None:
+        eval_loader = episode_pipeline.episodes('valid', eval_sampler)
+    else:
+        eval_loader = DataLoader(
+            eval_dataset,
+            batch_sampler=eval_sampler,
+            num_workers=args.num_workers,
+            pin_memory=args.device.type == 'cuda',
+            collate_fn=TrimmedCollate(eval_sampler.episodic_collate_fn, episode_pad_token_id(args)),
+        )
 
 
 
@@ -83,25 +167,22 @@ def evaluate(args, model, tokenizer,round_turn,time,tqdm_prefix: Optional[str] =
     model.eval()
     with torch.no_grad():
         # We use a tqdm context to show a progress bar in the logs
+        # 每 eval_batch_size 个 episode 合并为一次 backbone 前向
         with tqdm(
-                enumerate(eval_loader),
-                total=len(eval_loader),
+                enumerate(group_episodes(eval_loader, args.eval_batch_size)),
+                total=ceil(len(eval_loader) / args.eval_batch_size),
                 desc=tqdm_prefix,
         ) as tqdm_eval:
-            for _, (
-                    support_images,
-                    support_labels,
-                    query_images,
-                    query_labels,
-                    _,
-            ) in tqdm_eval:
-                correct, total = evaluate_one_task(
-                    model,
-                    support_images.to(args.device),
-                    support_labels.to(args.device),
-                    query_images.to(args.device),
-                    query_labels.to(args.device),
-                )
+            for _, episodes in tqdm_eval:
+                with mixed_precision(args.device, args.bf16):
+                    correct, total = evaluate_episodes(
+                        model,
+                        [(support_images.to(args.device), support_labels.to(args.device), query_images.to(args.device))
+                         for support_images, support_labels, query_images, _, _ in episodes],
+                        torch.cat([query_labels for _, _, _, query_labels, _ in episodes]).to(args.device),
+                        fused=args.fused_episodes,
+                        pad_token_id=concat_pad_token_id(args),
+                    )
 
 
                 total_predictions += total
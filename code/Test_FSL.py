@@ -1,15 +1,17 @@
 import logging
 import os
-import pickle
 import random
 import numpy as np
 import torch
 from easyfsl.datasets import WrapFewShotDataset
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
-from torch.utils.data import DataLoader, Sampler, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, Sampler, RandomSampler, SequentialSampler, TensorDataset
 
 import pandas as pd
 from tqdm import tqdm
+from Evaluate_FSL import episode_scores, mixed_precision
+from embedding_cache import backbone_mode, compute_embeddings, compute_hidden_states, freeze_backbone
+from episode_loader import concat_pad_token_id, episode_pad_token_id, trim_padding
 from fsl_text_dataset import FewShotTextDataset
 
 logger = logging.getLogger(__name__)
@@ -32,36 +34,44 @@ def sample_support_set(train_dataset, n_way, n_shot):
     return support_indices
 
 def test(args, model, tokenizer, round_turn, time):
-    if not args.isLocal:
-        eval_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.test_data_file))
-        train_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.train_data_file))
-        with open(f'../data{time}/pkl/test_dataset{round_turn}.pkl', 'wb') as f:
-            pickle.dump(eval_dataset, f)
-        with open(f'../data{time}/pkl/train_dataset{round_turn}.pkl', 'wb') as f:
-            pickle.dump(train_dataset, f)
-    else:
-        with open(f'../data{time}/pkl/test_dataset{round_turn}.pkl', 'rb') as f:
-            eval_dataset = pickle.load(f)
-        with open(f'../data{time}/pkl/train_dataset{round_turn}.pkl', 'rb') as f:
-            train_dataset = pickle.load(f)
+    # 数据集缓存按数据文件区分，测试用的整个训练集不会覆盖各 fold 的训练集缓存
+    eval_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.test_data_file))
+    train_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.train_data_file))
+
+    query_dataset = eval_dataset
+    train_features = None
+    states = None
+    features = None
+    if args.freeze_backbone:
+        # 冻结模式：测试集和训练集的 CLS 嵌入各计算一次（通常已在训练时缓存），查询和支持集直接取嵌入
+        freeze_backbone(model)
+        features = compute_embeddings(args, model, {'test': eval_dataset, 'train': train_dataset})
+    elif args.freeze_layers > 0:
+        # 底部各层在训练时冻结，权重与缓存一致：查询和支持集直接取第 K 层隐藏状态的位置，只运行上层
+        features, states = compute_hidden_states(args, model, {'test': eval_dataset, 'train': train_dataset})
+    if features is not None:
+        train_features = torch.from_numpy(features['train'])
+        query_dataset = TensorDataset(torch.from_numpy(features['test']),
+                                      torch.from_numpy(eval_dataset.source_dataset.example_labels))
 
     # 使用普通的 SequentialSampler
-    eval_sampler = SequentialSampler(eval_dataset)
-    n_workers = 4
+    eval_sampler = SequentialSampler(query_dataset)
     eval_loader = DataLoader(
-        eval_dataset,
+        query_dataset,
         sampler=eval_sampler,
         batch_size=1,  # 每次加载一个查询样本
-        num_workers=n_workers,
-        pin_memory=True,
+        # 冻结模式下查询集只是内存中的嵌入（或位置）矩阵，不需要 worker 进程
+        num_workers=0 if train_features is not None else args.num_workers,
+        pin_memory=args.device.type == 'cuda',
     )
 
     logger.info("***** Running Test *****")
     logger.info("  Num examples = %d", len(eval_dataset))
     true_labels = []
     predicted_labels = []
+    pad_token_id = episode_pad_token_id(args)
     model.eval()
-    with torch.no_grad():
+    with torch.no_grad(), backbone_mode(args, model, states), mixed_precision(args.device, args.bf16):
         for query_sample in tqdm(eval_loader, desc="Evaluating"):
             # 每次从测试集中获取一个查询样本
             query_image, query_label = query_sample
@@ -70,8 +80,15 @@ def test(args, model, tokenizer, round_turn, time):
             support_indices = sample_support_set(train_dataset, args.n_way, args.n_shot)
 
             # 获取支持集的样本和标签
-            support_images = torch.stack([train_dataset[idx][0] for idx in support_indices])
+            if train_features is not None:
+                support_images = train_features[support_indices]
+            else:
+                support_images = torch.stack([train_dataset[idx][0] for idx in support_indices])
             support_labels = torch.tensor([train_dataset.labels[idx] for idx in support_indices])
+            if pad_token_id is not None and train_features is None:
+                # 支持集与查询样本分别只填充到各自的最大长度
+                support_images = trim_padding(support_images, pad_token_id)
+                query_image = trim_padding(query_image, pad_token_id)
 
             # 确保将数据转为torch.Tensor并移动到设备上
             support_images = support_images.to(args.device)
@@ -80,8 +97,8 @@ def test(args, model, tokenizer, round_turn, time):
             query_label = query_label.to(args.device)
 
             # 处理支持集并进行预测
-            model.process_support_set(support_images, support_labels)
-            predictions = model(query_image).detach()
+            predictions = episode_scores(model, support_images, support_labels, query_image,
+                                         fused=args.fused_episodes, pad_token_id=concat_pad_token_id(args)).detach()
             predicted_class = torch.argmax(predictions, dim=1).cpu().numpy()[0]
 
             true_labels.append(query_label.cpu().numpy())
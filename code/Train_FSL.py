@@ -2,12 +2,11 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 import os
-import pickle
+from math import ceil
 
 import torch
 from easyfsl.datasets import WrapFewShotDataset
 from easyfsl.methods import FewShotClassifier
-from easyfsl.samplers import TaskSampler
 from torch import nn
 from torch.optim import Optimizer, SGD
 from torch.optim.lr_scheduler import MultiStepLR
@@ -16,35 +15,41 @@ from statistics import mean
 
 from tqdm import tqdm
 
-from Evaluate_FSL import evaluate
+from Evaluate_FSL import batched_episode_scores, evaluate, mixed_precision
+from embedding_cache import (backbone_mode, compute_embeddings, compute_hidden_states, freeze_backbone,
+                             freeze_bottom_layers)
+from episode_loader import (TensorEpisodeGatherer, TrimmedCollate, concat_pad_token_id, episode_pad_token_id,
+                            group_episodes, make_task_sampler, open_episode_pipeline)
 from fsl_text_dataset import FewShotTextDataset
 logger = logging.getLogger(__name__)
 
 
 # 一轮训练函数
 def training_epoch(
-        model: FewShotClassifier, data_loader: DataLoader, optimizer: Optimizer,LOSS_FUNCTION,DEVICE
+        model: FewShotClassifier, data_loader: DataLoader, optimizer: Optimizer,LOSS_FUNCTION,DEVICE,
+        fused=False, pad_token_id=None, episodes_per_step=1, bf16=False
 ):
     all_loss = []
     model.train()
 
+    # 每 episodes_per_step 个 episode 合并为一次 backbone 前向和一次优化器更新，损失为所有查询的平均
     with tqdm(
-            enumerate(data_loader), total=len(data_loader), desc="Training"
+            enumerate(group_episodes(data_loader, episodes_per_step)),
+            total=ceil(len(data_loader) / episodes_per_step), desc="Training"
     ) as tqdm_train:
-        for episode_index, (
-                support_images,
-                support_labels,
-                query_images,
-                query_labels,
-                _,
-        ) in tqdm_train:
+        for episode_index, episodes in tqdm_train:
             optimizer.zero_grad()
-            model.process_support_set(
-                support_images.to(DEVICE), support_labels.to(DEVICE)
-            )
-            classification_scores = model(query_images.to(DEVICE))
-
-            loss = LOSS_FUNCTION(classification_scores, query_labels.to(DEVICE))
+            # --bf16 时前向在 bfloat16 autocast 下运行，损失在 autocast 之外以 float32 计算
+            with mixed_precision(DEVICE, bf16):
+                classification_scores = batched_episode_scores(
+                    model,
+                    [(support_images.to(DEVICE), support_labels.to(DEVICE), query_images.to(DEVICE))
+                     for support_images, support_labels, query_images, _, _ in episodes],
+                    fused=fused, pad_token_id=pad_token_id
+                )
+            query_labels = torch.cat([query_labels for _, _, _, query_labels, _ in episodes])
+
+            loss = LOSS_FUNCTION(classification_scores.float(), query_labels.to(DEVICE))
             loss.backward()
             optimizer.step()
 
@@ -56,26 +61,36 @@ def training_epoch(
 
 def train(args, model, tokenizer,round_turn,time):
     """ Train the model """
-    if not args.isLocal :
-
-        train_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.train_data_file))
-
-        with open(f'../data{time}/pkl/train_dataset{round_turn}.pkl', 'wb') as f:
-            pickle.dump(train_dataset, f)
-    else:
-        with open(f'../data{time}/pkl/train_dataset{round_turn}.pkl', 'rb') as f:
-            train_dataset = pickle.load(f)
-    train_sampler = TaskSampler(
-        train_dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query, n_tasks=args.n_tasks_per_epoch
-    )
-    n_workers = 4
-    train_loader = DataLoader(
-        train_dataset,
-        batch_sampler=train_sampler,
-        num_workers=n_workers,
-        pin_memory=True,
-        collate_fn=train_sampler.episodic_collate_fn,
-    )
+    # 数据集缓存未过期时直接加载，否则重新构建并写入缓存
+    train_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.train_data_file))
+    train_sampler = make_task_sampler(args, train_dataset, n_tasks=args.n_tasks_per_epoch)
+    eval_dataset = None
+    episode_pipeline = None
+    states = None
+    if args.freeze_layers > 0:
+        # 底部各层冻结：第 K 层的隐藏状态只计算一次（float16、memmap），每个 episode 只运行上层和 FEAT
+        freeze_bottom_layers(model, args.freeze_layers)
+        eval_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.eval_data_file))
+        positions, states = compute_hidden_states(args, model, {'train': train_dataset, 'valid': eval_dataset})
+        episode_pipeline = TensorEpisodeGatherer({'train': train_dataset, 'valid': eval_dataset}, features=positions)
+    elif args.freeze_backbone:
+        # backbone 冻结时每个样本的 CLS 嵌入只计算一次（并缓存到磁盘），只训练 FEAT 的注意力模块
+        freeze_backbone(model)
+        eval_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.eval_data_file))
+        features = compute_embeddings(args, model, {'train': train_dataset, 'valid': eval_dataset})
+        episode_pipeline = TensorEpisodeGatherer({'train': train_dataset, 'valid': eval_dataset}, features=features)
+    elif args.episode_loader != 'dataloader':
+        # 常驻的 episode 来源在本 fold 的所有 epoch 中同时为训练和验证服务
+        eval_dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, args, args.eval_data_file))
+        episode_pipeline = open_episode_pipeline(args, {'train': train_dataset, 'valid': eval_dataset})
+    if episode_pipeline is None:
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=train_sampler,
+            num_workers=args.num_workers,
+            pin_memory=args.device.type == 'cuda',
+            collate_fn=TrimmedCollate(train_sampler.episodic_collate_fn, episode_pad_token_id(args)),
+        )
 
 
 
@@ -90,7 +105,8 @@ def train(args, model, tokenizer,round_turn,time):
     learning_rate = args.learning_rate
     # weight_decay用于防止过拟合
     train_optimizer = SGD(
-        model.parameters(), lr=learning_rate, momentum=0.9, weight_decay=args.weight_decay
+        [p for p in model.parameters() if p.requires_grad], lr=learning_rate, momentum=0.9,
+        weight_decay=args.weight_decay
     )
     # 学习多少个epoch后调整学习率
     scheduler_milestones = [2, 5, 9, 14]
@@ -104,34 +120,44 @@ def train(args, model, tokenizer,round_turn,time):
     best_acc = 0.0
     epochs_without_improvement = 0  # Early Stopping Counter
 
-    for epoch in range(args.num_train_epochs):
-        logger.info("Turn %d is training now---------------------",epoch)
-        average_loss = training_epoch(model, train_loader, train_optimizer,LOSS_FUNCTION,args.device)
-        logger.info("average_loss is :%s",average_loss)
-        average_acc = evaluate(args, model, tokenizer,round_turn,time=time,tqdm_prefix='Validating')
-        logger.info("average_acc is :%s",average_acc)
-
-        # Check for improvement
-        if average_acc > best_acc + args.min_delta:
-            best_acc = average_acc
-            epochs_without_improvement = 0
-            logger.info("  "+"*"*20)
-            logger.info("  Best acc:%s",round(best_acc,4))
-            logger.info("  "+"*"*20)
-            # Save best model checkpoint
-            output_dir = f'../data{time}/checkpoint-best-acc{round_turn}'
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            torch.save(model.state_dict(), os.path.join(output_dir, 'model.bin'))
-            logger.info("Model improved. Saving new best model to %s", output_dir)
-
-        else:
-            epochs_without_improvement += 1
-            logger.info("No improvement. Early stopping patience: %d/%d",
-                        epochs_without_improvement, args.early_stopping_patience)
-
-        # Early stopping condition
-        if epochs_without_improvement >= args.early_stopping_patience:
-            logger.info("Early stopping triggered.")
-            break
-        train_scheduler.step()
\ No newline at end of file
+    try:
+        for epoch in range(args.num_train_epochs):
+            logger.info("Turn %d is training now---------------------",epoch)
+            if episode_pipeline is not None:
+                train_loader = episode_pipeline.episodes('train', train_sampler)
+            with backbone_mode(args, model, states):
+                average_loss = training_epoch(model, train_loader, train_optimizer,LOSS_FUNCTION,args.device,
+                                              fused=args.fused_episodes, pad_token_id=concat_pad_token_id(args),
+                                              episodes_per_step=args.train_batch_size, bf16=args.bf16)
+                logger.info("average_loss is :%s",average_loss)
+                average_acc = evaluate(args, model, tokenizer,round_turn,time=time,tqdm_prefix='Validating',
+                                       eval_dataset=eval_dataset, episode_pipeline=episode_pipeline)
+            logger.info("average_acc is :%s",average_acc)
+
+            # Check for improvement
+            if average_acc > best_acc + args.min_delta:
+                best_acc = average_acc
+                epochs_without_improvement = 0
+                logger.info("  "+"*"*20)
+                logger.info("  Best acc:%s",round(best_acc,4))
+                logger.info("  "+"*"*20)
+                # Save best model checkpoint
+                output_dir = f'../data{time}/checkpoint-best-acc{round_turn}'
+                if not os.path.exists(output_dir):
+                    os.makedirs(output_dir)
+                torch.save(model.state_dict(), os.path.join(output_dir, 'model.bin'))
+                logger.info("Model improved. Saving new best model to %s", output_dir)
+
+            else:
+                epochs_without_improvement += 1
+                logger.info("No improvement. Early stopping patience: %d/%d",
+                            epochs_without_improvement, args.early_stopping_patience)
+
+            # Early stopping condition
+            if epochs_without_improvement >= args.early_stopping_patience:
+                logger.info("Early stopping triggered.")
+                break
+            train_scheduler.step()
+    finally:
+        if episode_pipeline is not None:
+            episode_pipeline.close()
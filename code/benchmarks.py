@@ -0,0 +1,585 @@
+import argparse
+import os
+import tempfile
+import time
+
+
+def _source_stats(root_dir):
+    """
+    统计root_dir下.py文件的数量和总字节数，用于换算吞吐量。
+    """
+    num_files = 0
+    num_bytes = 0
+    for foldername, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            if filename.endswith(".py"):
+                num_files += 1
+                num_bytes += os.path.getsize(os.path.join(foldername, filename))
+    return num_files, num_bytes
+
+
+def bench_ingest(args):
+    """
+    对比 read_python_files（DataFrame + iterrows）与 stream_python_files 在不同进程数下的耗时。
+    """
+    from pre_data import read_python_files, stream_python_files
+
+    num_files, num_bytes = _source_stats(args.root_dir)
+    print(f"Corpus: {num_files} files, {num_bytes / 2 ** 20:.1f} MB")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_jsonl = os.path.join(tmp_dir, 'tot_data.jsonl')
+        runs = [('read_python_files', lambda: read_python_files(args.root_dir, output_jsonl))]
+        for num_workers in args.num_workers:
+            runs.append((f'stream_python_files(num_workers={num_workers})',
+                         lambda n=num_workers: stream_python_files(args.root_dir, output_jsonl, num_workers=n)))
+
+        for name, run in runs:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {elapsed:.2f}s, {num_files / elapsed:.0f} files/s, "
+                  f"{num_bytes / 2 ** 20 / elapsed:.1f} MB/s")
+
+
+def bench_strip(args):
+    """
+    在 source/0 中最大的若干文件上，对比旧的正则注释移除与单遍词法扫描的耗时。
+    """
+    from pre_data import _strip_comments_regex, _strip_comments_scan
+
+    file_paths = [os.path.join(args.source_dir, name) for name in os.listdir(args.source_dir) if name.endswith('.py')]
+    file_paths = sorted(file_paths, key=os.path.getsize, reverse=True)[:args.top]
+
+    total_regex = total_scan = 0.0
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            code = f.read()
+        timings = []
+        for strip in (_strip_comments_regex, _strip_comments_scan):
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                strip(code)
+            timings.append((time.perf_counter() - start) / args.repeat)
+        total_regex += timings[0]
+        total_scan += timings[1]
+        print(f"{os.path.basename(file_path)} ({code.count(chr(10))} lines): "
+              f"regex {timings[0] * 1e3:.1f}ms, scan {timings[1] * 1e3:.1f}ms")
+    print(f"Total: regex {total_regex * 1e3:.1f}ms, scan {total_scan * 1e3:.1f}ms")
+
+
+def bench_tokenize(args):
+    """
+    在 source/0 中最大的若干文件上，对比完整分词后截断与 truncated_tokenize 的耗时，并检查结果一致。
+    """
+    from transformers import RobertaTokenizer
+    from fsl_text_dataset import truncated_tokenize
+    from pre_data import remove_comments_from_code
+
+    tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer_name, local_files_only=True)
+    max_tokens = args.block_size - 2
+    file_paths = [os.path.join(args.source_dir, name) for name in os.listdir(args.source_dir) if name.endswith('.py')]
+    file_paths = sorted(file_paths, key=os.path.getsize, reverse=True)[:args.top]
+
+    total_full = total_truncated = 0.0
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            code = remove_comments_from_code(f.read()) or ''
+        start = time.perf_counter()
+        full = tokenizer.tokenize(' '.join(code.split()))[:max_tokens]
+        elapsed_full = time.perf_counter() - start
+        start = time.perf_counter()
+        truncated = truncated_tokenize(code, tokenizer, max_tokens)
+        elapsed_truncated = time.perf_counter() - start
+        if full != truncated:
+            raise AssertionError(f"truncated_tokenize differs from full tokenization on {file_path}")
+        total_full += elapsed_full
+        total_truncated += elapsed_truncated
+        print(f"{os.path.basename(file_path)} ({len(code.split())} words): "
+              f"full {elapsed_full * 1e3:.1f}ms, truncated {elapsed_truncated * 1e3:.1f}ms")
+    print(f"Total: full {total_full * 1e3:.1f}ms, truncated {total_truncated * 1e3:.1f}ms "
+          f"({total_full / max(total_truncated, 1e-9):.1f}x)")
+
+
+def bench_featurize(args):
+    """
+    对比逐条的慢速分词与快速分词器批量（及多进程）分词构建特征的耗时，并检查 input_ids 逐条一致。
+    """
+    from transformers import RobertaTokenizer, RobertaTokenizerFast
+    from corpus_io import iter_records
+    from fsl_text_dataset import convert_examples_to_features, featurize_records
+
+    slow_tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer_name, local_files_only=True)
+    fast_tokenizer = RobertaTokenizerFast.from_pretrained(args.tokenizer_name, local_files_only=True)
+    records = list(iter_records(args.data_file))
+    if args.limit:
+        records = records[:args.limit]
+    print(f"Data: {len(records)} records, block_size={args.block_size}")
+
+    start = time.perf_counter()
+    expected = [convert_examples_to_features(js, slow_tokenizer, args) for js in records]
+    print(f"convert_examples_to_features (slow tokenizer): {time.perf_counter() - start:.2f}s")
+
+    for num_workers in args.num_workers:
+        start = time.perf_counter()
+        features = featurize_records(records, fast_tokenizer, args.block_size, num_workers=num_workers)
+        print(f"featurize_records(num_workers={num_workers}): {time.perf_counter() - start:.2f}s")
+        for js, feature, reference in zip(records, features, expected):
+            if feature.input_ids != reference.input_ids or feature.label != reference.label:
+                raise AssertionError(f"Batched features differ from convert_examples_to_features on {js.get('path')}")
+        if len(features) != len(expected):
+            raise AssertionError("Batched featurization returned a different number of examples.")
+    print("input_ids identical to convert_examples_to_features")
+
+
+def bench_slice(args):
+    """
+    统计 AST 切片前后每个样本的 token 数，以及完整装入各 block_size 的样本比例。
+    """
+    import numpy as np
+    from transformers import RobertaTokenizerFast
+    from corpus_io import iter_records
+    from relevance_slice import slice_relevant_code
+
+    tokenizer = RobertaTokenizerFast.from_pretrained(args.tokenizer_name, local_files_only=True)
+    records = list(iter_records(args.data_file))
+    if args.limit:
+        records = records[:args.limit]
+    codes = [' '.join(js['code'].split()) for js in records]
+
+    start = time.perf_counter()
+    sliced = [' '.join(slice_relevant_code(js['code']).split()) for js in records]
+    elapsed = time.perf_counter() - start
+    unchanged = sum(a == b for a, b in zip(codes, sliced))
+    print(f"Data: {len(records)} records, slicing {elapsed:.2f}s ({elapsed / len(records) * 1e3:.1f}ms/record), "
+          f"{unchanged} unchanged (unparsable or no quantum statements)")
+
+    for name, texts in (('full', codes), ('sliced', sliced)):
+        lengths = np.array([len(ids) + 2 for ids in tokenizer(texts, add_special_tokens=False)['input_ids']])
+        fits = ', '.join(f"{block_size}: {np.mean(lengths <= block_size) * 100:.1f}%" for block_size in args.block_sizes)
+        print(f"{name}: median {np.median(lengths):.0f} tokens, mean {lengths.mean():.0f}; fits in {fits}")
+
+
+def _codebert_for_length(model_name, kind, length, window):
+    """
+    构建能处理 length 个 token 的编码器：dense 为位置嵌入平铺到 length 的 RobertaModel，
+    longformer 为 roberta_to_longformer 转换的滑动窗口模型。
+    """
+    from transformers import RobertaConfig, RobertaModel
+    from long_backbone import extend_position_embeddings, roberta_to_longformer
+
+    roberta = RobertaModel.from_pretrained(model_name, local_files_only=True)
+    if kind == 'longformer':
+        return roberta_to_longformer(roberta, length, window)
+    config = RobertaConfig.from_pretrained(model_name, local_files_only=True)
+    config.max_position_embeddings = max(config.max_position_embeddings, length + config.pad_token_id + 1)
+    dense = RobertaModel(config, add_pooling_layer=roberta.pooler is not None)
+    state_dict = {name: value for name, value in roberta.state_dict().items() if 'position_ids' not in name}
+    state_dict['embeddings.position_embeddings.weight'] = extend_position_embeddings(
+        state_dict['embeddings.position_embeddings.weight'], config.max_position_embeddings, config.pad_token_id)
+    dense.load_state_dict(state_dict, strict=False)
+    return dense
+
+
+def _attention_trial(result_queue, model_name, kind, length, window, batch_size, repeat, backward):
+    """
+    在独立的进程中测量一种编码器在一个长度下的前向（及反向）耗时和峰值内存增量。
+    """
+    import resource
+    import torch
+    from main_fsl import CustomBackbone
+
+    torch.manual_seed(0)
+    model = CustomBackbone(_codebert_for_length(model_name, kind, length, window), pad_token_id=1)
+    model.train(backward)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device)
+    x = torch.randint(5, model.original_backbone.config.vocab_size, (batch_size, length), device=device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.max_memory_allocated()
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def step():
+        with torch.set_grad_enabled(backward):
+            output = model(x)
+            if backward:
+                output.sum().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step()
+    elapsed = (time.perf_counter() - start) / repeat
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result_queue.put((elapsed, peak - baseline))
+
+
+def bench_attention(args):
+    """
+    对比稠密注意力（CodeBERT）与滑动窗口注意力（roberta_to_longformer）在不同序列长度下的耗时和峰值内存。
+    每个组合在新的进程中运行，峰值内存互不影响；CPU 上的内存为进程最大常驻内存的增量。
+    """
+    import multiprocessing
+
+    context = multiprocessing.get_context('spawn')
+    mode = 'forward+backward' if args.backward else 'forward'
+    print(f"batch_size={args.batch_size}, attention_window={args.attention_window}, {mode}")
+    for length in args.lengths:
+        for kind in ('dense', 'longformer'):
+            result_queue = context.Queue()
+            process = context.Process(target=_attention_trial, args=(
+                result_queue, args.model_name_or_path, kind, length, args.attention_window, args.batch_size,
+                args.repeat, args.backward))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"{length:>5} {kind:>10}: failed (exit code {process.exitcode})")
+                continue
+            elapsed, memory = result_queue.get()
+            print(f"{length:>5} {kind:>10}: {elapsed * 1e3:8.1f}ms, peak memory +{memory / 2 ** 20:.0f} MB")
+
+
+def bench_episodes(args):
+    """
+    对比 TaskSampler + DataLoader（episodic_collate_fn）与进程内 TensorEpisodeGatherer 组装 episode 的耗时，
+    并检查两者对同一组下标产出相同的支持集/查询集。
+    """
+    from types import SimpleNamespace
+
+    import torch
+    from easyfsl.datasets import WrapFewShotDataset
+    from easyfsl.samplers import TaskSampler
+    from torch.utils.data import DataLoader
+    from transformers import RobertaTokenizer
+    from episode_loader import TensorEpisodeGatherer
+    from fsl_text_dataset import FewShotTextDataset
+
+    # 与 main_fsl 一致，DataLoader worker 以 spawn 方式启动
+    torch.multiprocessing.set_start_method('spawn', force=True)
+    tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer_name, local_files_only=True)
+    dataset_args = SimpleNamespace(block_size=args.block_size, token_cache_dir=args.token_cache_dir)
+    dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, dataset_args, args.data_file))
+    sampler = TaskSampler(dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query, n_tasks=args.n_tasks)
+    gatherer = TensorEpisodeGatherer({'train': dataset})
+    print(f"Data: {len(dataset)} examples, {args.n_tasks} tasks of {args.n_way}-way {args.n_shot}-shot {args.n_query}-query")
+
+    tasks = list(sampler)
+    for indices in tasks[:20]:
+        expected = sampler.episodic_collate_fn([dataset[i] for i in indices])
+        actual = gatherer.gather('train', indices, args.n_way, args.n_shot, args.n_query)
+        # episode 内标签编号方式可能不同，比较映射回数据集标签后的结果
+        for images, labels, expected_images, expected_labels in ((actual[0], actual[1], expected[0], expected[1]),
+                                                                  (actual[2], actual[3], expected[2], expected[3])):
+            if not torch.equal(images.long(), expected_images.long()) or \
+                    [actual[4][i] for i in labels] != [expected[4][i] for i in expected_labels]:
+                raise AssertionError(f"TensorEpisodeGatherer differs from episodic_collate_fn on {indices}")
+
+    runs = []
+    for num_workers in args.num_workers:
+        runs.append((f'TaskSampler + DataLoader(num_workers={num_workers})',
+                     lambda n=num_workers: DataLoader(dataset, batch_sampler=sampler, num_workers=n,
+                                                      collate_fn=sampler.episodic_collate_fn)))
+    runs.append(('TensorEpisodeGatherer', lambda: gatherer.episodes('train', sampler)))
+    for name, make_loader in runs:
+        start = time.perf_counter()
+        for _ in range(args.epochs):
+            for _ in make_loader():
+                pass
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f}s, {args.epochs * args.n_tasks / elapsed:.0f} episodes/s")
+
+
+def _random_episodes(config, n_tasks, n_way, n_shot, n_query, block_size):
+    """
+    随机 token 的 episode（长度在 block_size / 4 到 block_size 之间，其余为填充），供 fused / batch 使用。
+    """
+    import torch
+
+    n_support = n_way * n_shot
+    episodes = []
+    for _ in range(n_tasks):
+        x = torch.randint(5, config.vocab_size, (n_support + n_way * n_query, block_size))
+        for row, length in zip(x, torch.randint(block_size // 4, block_size + 1, (len(x),))):
+            row[length:] = config.pad_token_id
+        episodes.append((x[:n_support], torch.arange(n_way).repeat_interleave(n_shot), x[n_support:],
+                         torch.arange(n_way).repeat_interleave(n_query)))
+    return episodes
+
+
+def _feat_with_codebert(model_name):
+    """
+    与 main_fsl 相同结构的 FEAT（CustomBackbone + MultiHeadAttention），返回 (model, config)。
+    """
+    import torch
+    from easyfsl.methods import FEAT
+    from easyfsl.modules import MultiHeadAttention
+    from transformers import RobertaModel
+    from main_fsl import CustomBackbone
+
+    torch.manual_seed(0)
+    roberta = RobertaModel.from_pretrained(model_name, local_files_only=True)
+    config = roberta.config
+    model = FEAT(backbone=CustomBackbone(roberta, pad_token_id=config.pad_token_id),
+                 attention_module=MultiHeadAttention(8, config.hidden_size, 640, 640))
+    return model, config
+
+
+def bench_fused(args):
+    """
+    对比每个 episode 运行两次 backbone（支持集、查询集分别编码）与 --fused_episodes 只运行一次的耗时，
+    并检查 eval 模式下两者的查询得分相同。
+    """
+    import torch
+    from Evaluate_FSL import episode_scores
+
+    model, config = _feat_with_codebert(args.model_name_or_path)
+    pad_token_id = config.pad_token_id
+    episodes = [episode[:3] for episode in _random_episodes(
+        config, args.n_tasks, args.n_way, args.n_shot, args.n_query, args.block_size)]
+    model.eval()
+    with torch.no_grad():
+        for support, labels, query in episodes[:5]:
+            expected = episode_scores(model, support, labels, query)
+            actual = episode_scores(model, support, labels, query, fused=True, pad_token_id=pad_token_id)
+            difference = (expected - actual).abs().max().item()
+            if difference > 1e-4:
+                raise AssertionError(f"Fused episode scores differ by {difference}")
+    print(f"{args.n_way}-way {args.n_shot}-shot {args.n_query}-query, block_size={args.block_size}, "
+          f"threads={torch.get_num_threads()}, max score difference {difference:.1e}")
+
+    for mode in ('eval', 'train'):
+        model.train(mode == 'train')
+        for fused in (False, True):
+            def step(support, labels, query):
+                with torch.set_grad_enabled(mode == 'train'):
+                    scores = episode_scores(model, support, labels, query, fused=fused, pad_token_id=pad_token_id)
+                    if mode == 'train':
+                        scores.sum().backward()
+                        model.zero_grad()
+
+            step(*episodes[0])
+            start = time.perf_counter()
+            for support, labels, query in episodes:
+                step(support, labels, query)
+            elapsed = (time.perf_counter() - start) / len(episodes)
+            print(f"{mode:>5} {'fused' if fused else 'separate':>8}: {elapsed * 1e3:8.1f}ms/episode")
+
+
+def bench_batch(args):
+    """
+    对比 --train_batch_size / --eval_batch_size 取不同值时的吞吐量（episodes/s），
+    并检查 eval 模式下多个 episode 合并计算的得分与逐个计算相同。
+    """
+    import torch
+    from torch import nn
+    from Evaluate_FSL import batched_episode_scores
+
+    model, config = _feat_with_codebert(args.model_name_or_path)
+    pad_token_id = config.pad_token_id
+    episodes = _random_episodes(config, args.n_tasks, args.n_way, args.n_shot, args.n_query, args.block_size)
+    model.eval()
+    with torch.no_grad():
+        group = [episode[:3] for episode in episodes[:max(args.batch_sizes)]]
+        expected = torch.cat([batched_episode_scores(model, [episode]) for episode in group])
+        actual = batched_episode_scores(model, group, pad_token_id=pad_token_id)
+        difference = (expected - actual).abs().max().item()
+        if difference > 1e-4:
+            raise AssertionError(f"Batched episode scores differ by {difference}")
+    print(f"{args.n_way}-way {args.n_shot}-shot {args.n_query}-query, block_size={args.block_size}, "
+          f"threads={torch.get_num_threads()}, max score difference {difference:.1e}")
+
+    loss_function = nn.CrossEntropyLoss()
+    for mode in ('eval', 'train'):
+        model.train(mode == 'train')
+        for batch_size in args.batch_sizes:
+            groups = [episodes[i:i + batch_size] for i in range(0, len(episodes), batch_size)]
+
+            def step(group):
+                with torch.set_grad_enabled(mode == 'train'):
+                    scores = batched_episode_scores(model, [episode[:3] for episode in group],
+                                                    pad_token_id=pad_token_id)
+                    if mode == 'train':
+                        loss_function(scores, torch.cat([episode[3] for episode in group])).backward()
+                        model.zero_grad()
+
+            step(groups[0])
+            start = time.perf_counter()
+            for group in groups:
+                step(group)
+            elapsed = time.perf_counter() - start
+            print(f"{mode:>5} B={batch_size:<3}: {len(episodes) / elapsed:6.2f} episodes/s")
+
+
+def bench_bf16(args):
+    """
+    --bf16 的验证集精度一致性检查：在同一组验证 episode 上分别以 float32 和 bfloat16 autocast 评估
+    （可加载 main_fsl 保存的 checkpoint），比较准确率、预测一致率和得分差异，并对比评估和训练步的耗时。
+    """
+    import random
+    from types import SimpleNamespace
+
+    import torch
+    from easyfsl.datasets import WrapFewShotDataset
+    from easyfsl.samplers import TaskSampler
+    from transformers import RobertaTokenizer
+    from Evaluate_FSL import batched_episode_scores, mixed_precision
+    from episode_loader import TensorEpisodeGatherer
+    from fsl_text_dataset import FewShotTextDataset
+
+    model, config = _feat_with_codebert(args.model_name_or_path)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer_name, local_files_only=True)
+    dataset_args = SimpleNamespace(block_size=args.block_size, token_cache_dir=args.token_cache_dir)
+    dataset = WrapFewShotDataset(FewShotTextDataset(tokenizer, dataset_args, args.data_file))
+    random.seed(0)
+    sampler = TaskSampler(dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query, n_tasks=args.n_tasks)
+    gatherer = TensorEpisodeGatherer({'valid': dataset}, pad_token_id=config.pad_token_id)
+    episodes = [gatherer.gather('valid', indices, args.n_way, args.n_shot, args.n_query)[:4] for indices in sampler]
+    device = torch.device('cpu')
+    print(f"{len(episodes)} episodes of {args.n_way}-way {args.n_shot}-shot {args.n_query}-query, "
+          f"block_size={args.block_size}, threads={torch.get_num_threads()}, "
+          f"native bf16: {getattr(torch.cpu, '_is_avx512_bf16_supported', lambda: False)()}")
+
+    model.eval()
+    results = {}
+    for bf16 in (False, True):
+        with torch.no_grad(), mixed_precision(device, bf16):
+            batched_episode_scores(model, [episodes[0][:3]], pad_token_id=config.pad_token_id)
+            start = time.perf_counter()
+            scores = [batched_episode_scores(model, [episode[:3]], pad_token_id=config.pad_token_id).float()
+                      for episode in episodes]
+            elapsed = (time.perf_counter() - start) / len(episodes)
+        scores = torch.cat(scores)
+        labels = torch.cat([episode[3] for episode in episodes])
+        accuracy = (scores.argmax(dim=1) == labels).float().mean().item()
+        results[bf16] = scores
+        print(f"eval {'bf16' if bf16 else 'fp32'}: accuracy {100 * accuracy:.2f}%, {elapsed * 1e3:.1f}ms/episode")
+    agreement = (results[False].argmax(dim=1) == results[True].argmax(dim=1)).float().mean().item()
+    difference = (results[False] - results[True]).abs().max().item()
+    print(f"prediction agreement {100 * agreement:.2f}%, max score difference {difference:.3g}")
+
+    model.train()
+    loss_function = torch.nn.CrossEntropyLoss()
+    for bf16 in (False, True):
+        def step(episode):
+            with mixed_precision(device, bf16):
+                scores = batched_episode_scores(model, [episode[:3]], pad_token_id=config.pad_token_id)
+            loss_function(scores.float(), episode[3]).backward()
+            model.zero_grad()
+
+        step(episodes[0])
+        train_episodes = episodes[:args.train_steps]
+        start = time.perf_counter()
+        for episode in train_episodes:
+            step(episode)
+        elapsed = (time.perf_counter() - start) / len(train_episodes)
+        print(f"train {'bf16' if bf16 else 'fp32'}: {elapsed * 1e3:.1f}ms/step")
+
+
+def read_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="Corpus ingestion (pre_data).")
+    ingest.add_argument("--root_dir", default='../source', type=str)
+    ingest.add_argument("--num_workers", default=[1, 2, 4, 8], type=int, nargs='+')
+    ingest.set_defaults(func=bench_ingest)
+
+    strip = subparsers.add_parser('strip', help="Comment stripping on the largest source files.")
+    strip.add_argument("--source_dir", default='../source/0', type=str)
+    strip.add_argument("--top", default=10, type=int)
+    strip.add_argument("--repeat", default=5, type=int)
+    strip.set_defaults(func=bench_strip)
+
+    tokenize = subparsers.add_parser('tokenize', help="Truncation-aware tokenization on the largest source files.")
+    tokenize.add_argument("--tokenizer_name", default='./pretrained_models/codebert_base', type=str)
+    tokenize.add_argument("--source_dir", default='../source/0', type=str)
+    tokenize.add_argument("--block_size", default=256, type=int)
+    tokenize.add_argument("--top", default=10, type=int)
+    tokenize.set_defaults(func=bench_tokenize)
+
+    featurize = subparsers.add_parser('featurize', help="Batched fast-tokenizer featurization vs. the slow path.")
+    featurize.add_argument("--tokenizer_name", default='./pretrained_models/codebert_base', type=str)
+    featurize.add_argument("--data_file", default='../tot_data.jsonl', type=str)
+    featurize.add_argument("--block_size", default=256, type=int)
+    featurize.add_argument("--limit", default=0, type=int)
+    featurize.add_argument("--num_workers", default=[0, 4], type=int, nargs='+')
+    featurize.set_defaults(func=bench_featurize)
+
+    slicing = subparsers.add_parser('slice', help="Token lengths before and after AST relevance slicing.")
+    slicing.add_argument("--tokenizer_name", default='./pretrained_models/codebert_base', type=str)
+    slicing.add_argument("--data_file", default='../tot_data.jsonl', type=str)
+    slicing.add_argument("--limit", default=0, type=int)
+    slicing.add_argument("--block_sizes", default=[128, 256, 512], type=int, nargs='+')
+    slicing.set_defaults(func=bench_slice)
+
+    attention = subparsers.add_parser('attention', help="Dense vs. sliding-window attention backbone by length.")
+    attention.add_argument("--model_name_or_path", default='./pretrained_models/codebert_base', type=str)
+    attention.add_argument("--lengths", default=[256, 512, 1024, 2048], type=int, nargs='+')
+    attention.add_argument("--attention_window", default=256, type=int)
+    attention.add_argument("--batch_size", default=8, type=int)
+    attention.add_argument("--repeat", default=3, type=int)
+    attention.add_argument("--backward", action='store_true')
+    attention.set_defaults(func=bench_attention)
+
+    episodes = subparsers.add_parser('episodes', help="Episode assembly: DataLoader path vs. in-process gather.")
+    episodes.add_argument("--tokenizer_name", default='./pretrained_models/codebert_base', type=str)
+    episodes.add_argument("--data_file", default='../data0/0data.jsonl', type=str)
+    episodes.add_argument("--token_cache_dir", default='../token_cache', type=str)
+    episodes.add_argument("--block_size", default=256, type=int)
+    episodes.add_argument("--n_way", default=2, type=int)
+    episodes.add_argument("--n_shot", default=7, type=int)
+    episodes.add_argument("--n_query", default=1, type=int)
+    episodes.add_argument("--n_tasks", default=200, type=int)
+    episodes.add_argument("--epochs", default=3, type=int)
+    episodes.add_argument("--num_workers", default=[0, 4], type=int, nargs='+')
+    episodes.set_defaults(func=bench_episodes)
+
+    fused = subparsers.add_parser('fused', help="One backbone pass per episode vs. separate support/query passes.")
+    fused.add_argument("--model_name_or_path", default='./pretrained_models/codebert_base', type=str)
+    fused.add_argument("--block_size", default=256, type=int)
+    fused.add_argument("--n_way", default=2, type=int)
+    fused.add_argument("--n_shot", default=7, type=int)
+    fused.add_argument("--n_query", default=1, type=int)
+    fused.add_argument("--n_tasks", default=10, type=int)
+    fused.set_defaults(func=bench_fused)
+
+    batch = subparsers.add_parser('batch', help="Episodes per backbone forward (--train_batch_size / --eval_batch_size).")
+    batch.add_argument("--model_name_or_path", default='./pretrained_models/codebert_base', type=str)
+    batch.add_argument("--block_size", default=256, type=int)
+    batch.add_argument("--n_way", default=2, type=int)
+    batch.add_argument("--n_shot", default=7, type=int)
+    batch.add_argument("--n_query", default=1, type=int)
+    batch.add_argument("--n_tasks", default=16, type=int)
+    batch.add_argument("--batch_sizes", default=[1, 2, 4, 8], type=int, nargs='+')
+    batch.set_defaults(func=bench_batch)
+
+    bf16 = subparsers.add_parser('bf16', help="Validation accuracy and speed of --bf16 autocast vs. float32.")
+    bf16.add_argument("--model_name_or_path", default='./pretrained_models/codebert_base', type=str)
+    bf16.add_argument("--tokenizer_name", default='./pretrained_models/codebert_base', type=str)
+    bf16.add_argument("--checkpoint", default='', type=str,
+                      help="FEAT state dict saved by main_fsl (checkpoint-best-acc*/model.bin).")
+    bf16.add_argument("--data_file", default='../data0/0data.jsonl', type=str)
+    bf16.add_argument("--token_cache_dir", default='../token_cache', type=str)
+    bf16.add_argument("--block_size", default=256, type=int)
+    bf16.add_argument("--n_way", default=2, type=int)
+    bf16.add_argument("--n_shot", default=7, type=int)
+    bf16.add_argument("--n_query", default=1, type=int)
+    bf16.add_argument("--n_tasks", default=100, type=int)
+    bf16.add_argument("--train_steps", default=10, type=int)
+    bf16.set_defaults(func=bench_bf16)
+
+    return parser
+
+
+if __name__ == '__main__':
+    args = read_args().parse_args()
+    args.func(args)
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from corpus_store import CorpusStore, is_corpus_store
+
+MANIFEST_NAME = 'manifest.json'
+# 基于行号的数据划分文件后缀，内容为 ids（行号数组）和 store（语料库目录）
+ID_SPLIT_SUFFIX = '.ids.npz'
+
+
+def _manifest_path(path):
+    """
+    path 可以是分片目录或其中的 manifest.json，返回 manifest.json 路径；普通jsonl文件返回 None。
+    """
+    if os.path.isdir(path):
+        return os.path.join(path, MANIFEST_NAME)
+    if os.path.basename(path) == MANIFEST_NAME:
+        return path
+    return None
+
+
+def _jsonl_files(path):
+    """
+    返回语料包含的jsonl文件列表（单个文件，或按manifest顺序排列的分片）。
+    """
+    manifest_path = _manifest_path(path)
+    if manifest_path is None:
+        return [path]
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    shard_dir = os.path.dirname(manifest_path)
+    return [os.path.join(shard_dir, shard['file']) for shard in manifest['shards']]
+
+
+def iter_jsonl(path):
+    """
+    逐条读取语料记录，同时支持单个jsonl文件和 ShardWriter 写出的分片目录。
+
+    参数:
+        path (str): jsonl文件路径，或分片目录 / 其 manifest.json 的路径。
+
+    返回:
+        生成器，依次产出每一行解析后的dict。
+    """
+    for file_path in _jsonl_files(path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line.strip())
+
+
+def save_id_split(file_path, ids, store_dir):
+    """
+    将一个数据划分保存为指向列式语料库的行号数组，而不是复制代码内容。
+    """
+    np.savez(file_path, ids=np.asarray(ids, dtype=np.int64), store=np.array(os.path.abspath(store_dir)))
+
+
+def load_id_split(file_path):
+    """
+    返回:
+        tuple: (ids, store_dir)
+    """
+    with np.load(file_path) as data:
+        return data['ids'], str(data['store'])
+
+
+def iter_records(path):
+    """
+    逐条读取语料记录：
+        - corpus_store 语料库目录：直接按行读取 mmap 的列；
+        - *.ids.npz 划分文件：按行号从对应语料库中惰性读取；
+        - 其他：按 iter_jsonl 读取jsonl文件或分片目录。
+    """
+    if path.endswith(ID_SPLIT_SUFFIX):
+        ids, store_dir = load_id_split(path)
+        store = CorpusStore(store_dir)
+        return (store[i] for i in ids)
+    if is_corpus_store(path):
+        return iter(CorpusStore(path))
+    return iter_jsonl(path)
+
+
+def source_fingerprint(path):
+    """
+    计算 iter_records 所读数据的内容指纹，数据内容变化时随之变化：
+        - *.ids.npz 划分文件：行号数组加上对应语料库的指纹；
+        - corpus_store 语料库目录：语料库自身的指纹；
+        - 其他：jsonl文件（或各分片）内容的 sha1。
+    """
+    sha1 = hashlib.sha1()
+    if path.endswith(ID_SPLIT_SUFFIX):
+        ids, store_dir = load_id_split(path)
+        sha1.update(CorpusStore(store_dir).fingerprint.encode('ascii'))
+        sha1.update(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+        return sha1.hexdigest()
+    if is_corpus_store(path):
+        return CorpusStore(path).fingerprint
+    for file_path in _jsonl_files(path):
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+class JsonlIndex(object):
+    """
+    按 key（如 path）取回旧输出中的原始行。位置来自写入时记录的 (文件, 字节偏移, 长度)
+    （pre_data 的增量清单），不需要重新读取和解析整份语料。
+    """
+    def __init__(self, path, locations):
+        """
+        参数:
+            path (str): 写入时的输出路径（单个jsonl文件或分片目录）。
+            locations (dict): key -> (文件, 偏移, 长度)，即写入器 write / write_line 的返回值。
+        """
+        manifest_path = _manifest_path(path)
+        self.base_dir = os.path.dirname(manifest_path) if manifest_path is not None else None
+        self.path = path
+        self.locations = locations
+        self.files = {}
+
+    def __contains__(self, value):
+        return value in self.locations
+
+    def _resolve(self, file_name):
+        # 单个jsonl文件写入时文件名为 None
+        return self.path if file_name is None else os.path.join(self.base_dir, file_name)
+
+    def get_line(self, value):
+        """
+        返回 key 对应的原始jsonl行（bytes，含换行符），按记录的字节范围直接读取。
+        """
+        file_name, offset, length = self.locations[value]
+        file_path = self._resolve(file_name)
+        if file_path not in self.files:
+            self.files[file_path] = open(file_path, 'rb')
+        f = self.files[file_path]
+        # 未变化的记录通常按原顺序读取，已在正确位置时不再 seek，保留读缓冲
+        if f.tell() != offset:
+            f.seek(offset)
+        return f.read(length)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class JsonlWriter(object):
+    """将记录写入单个jsonl文件；先写临时文件，close 时再替换目标文件。"""
+    def __init__(self, output_jsonl):
+        self.output_jsonl = output_jsonl
+        self.tmp_path = output_jsonl + '.tmp'
+        self.num_records = 0
+        self.num_bytes = 0
+        self.file = open(self.tmp_path, 'wb')
+
+    def write(self, record):
+        return self.write_line((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def write_line(self, line):
+        """
+        直接写入一行已序列化的记录（bytes，含换行符）。
+
+        返回:
+            tuple: 该行的位置 (None, 字节偏移, 长度)，可交给 JsonlIndex 取回。
+        """
+        offset = self.num_bytes
+        self.file.write(line)
+        self.num_records += 1
+        self.num_bytes += len(line)
+        return None, offset, len(line)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.output_jsonl)
+
+
+class ShardWriter(object):
+    """
+    将记录写入大小受限的jsonl分片，并在 close 时生成 manifest.json。
+    内存中只保留当前分片的文件句柄，峰值内存与语料规模无关。
+    """
+    def __init__(self, output_dir, shard_size):
+        """
+        参数:
+            output_dir (str): 分片目录，例如 ../tot_data。
+            shard_size (int): 单个分片的最大字节数（单条记录超过该值时独占一个分片）。
+        """
+        self.output_dir = output_dir
+        self.tmp_dir = output_dir.rstrip(os.sep) + '.tmp'
+        self.shard_size = shard_size
+        self.shards = []
+        self.num_records = 0
+        self.file = None
+
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+
+    def _open_shard(self):
+        if self.file is not None:
+            self.file.close()
+        name = f'shard-{len(self.shards):05d}.jsonl'
+        self.shards.append({'file': name, 'num_records': 0, 'num_bytes': 0})
+        self.file = open(os.path.join(self.tmp_dir, name), 'wb')
+
+    def write(self, record):
+        return self.write_line((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def write_line(self, line):
+        """
+        直接写入一行已序列化的记录（bytes，含换行符）。
+
+        返回:
+            tuple: 该行的位置 (分片文件名, 字节偏移, 长度)，可交给 JsonlIndex 取回。
+        """
+        if self.file is None or (self.shards[-1]['num_bytes'] > 0
+                                 and self.shards[-1]['num_bytes'] + len(line) > self.shard_size):
+            self._open_shard()
+        shard = self.shards[-1]
+        offset = shard['num_bytes']
+        self.file.write(line)
+        shard['num_records'] += 1
+        shard['num_bytes'] += len(line)
+        self.num_records += 1
+        return shard['file'], offset, len(line)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        manifest = {'num_records': self.num_records, 'shard_size': self.shard_size, 'shards': self.shards}
+        with open(os.path.join(self.tmp_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        if os.path.exists(self.output_dir):
+            # 只覆盖之前由 ShardWriter 写出的目录，避免误删其他数据
+            if not os.path.exists(os.path.join(self.output_dir, MANIFEST_NAME)):
+                raise FileExistsError(f"'{self.output_dir}' exists and is not a shard directory.")
+            shutil.rmtree(self.output_dir)
+        os.replace(self.tmp_dir, self.output_dir)
+
+
+def open_corpus_writer(output, shard_size=None):
+    """
+    shard_size 为空时写单个jsonl文件，否则在 output 目录下写分片和manifest。
+    """
+    if shard_size:
+        return ShardWriter(output, shard_size)
+    return JsonlWriter(output)
@@ -0,0 +1,172 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from array import array
+
+import numpy as np
+
+STORE_VERSION = 2
+META_NAME = 'meta.json'
+
+
+def is_corpus_store(path):
+    """
+    判断 path 是否为 build_corpus_store 写出的语料库目录。
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_NAME)) \
+        and os.path.exists(os.path.join(path, 'code.bin'))
+
+
+def _open_blob(file_path):
+    """
+    以只读方式 mmap 一个blob文件；空文件无法 mmap，直接返回空 bytes。
+    """
+    if os.path.getsize(file_path) == 0:
+        return b''
+    with open(file_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class CorpusStore(object):
+    """
+    列式、可内存映射的语料库。目录结构：
+        code.bin / code_offsets.npy   所有代码按utf-8拼接，第 i 行为 [offsets[i], offsets[i+1])
+        path.bin / path_offsets.npy   相对路径，同上
+        labels.npy                    int64 标签
+        hashes.npy                    清洗后代码的 sha1（S40）
+        groups.npy                    近似重复组代表所在的行号（int64，未分组时为自身行号）
+        meta.json                     版本、行数和整体指纹
+    所有数组以 mmap 方式加载，按行号取任意一行都不需要解析整个文件。
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_NAME), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError(f"Unsupported corpus store version in '{store_dir}': {self.meta.get('version')}")
+
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode='r')
+        self.hashes = np.load(os.path.join(store_dir, 'hashes.npy'), mmap_mode='r')
+        self.groups = np.load(os.path.join(store_dir, 'groups.npy'), mmap_mode='r')
+        self.code_offsets = np.load(os.path.join(store_dir, 'code_offsets.npy'), mmap_mode='r')
+        self.path_offsets = np.load(os.path.join(store_dir, 'path_offsets.npy'), mmap_mode='r')
+        self.code_blob = _open_blob(os.path.join(store_dir, 'code.bin'))
+        self.path_blob = _open_blob(os.path.join(store_dir, 'path.bin'))
+
+    def __getstate__(self):
+        # 只序列化目录路径，子进程中重新 mmap，而不是复制整份语料
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+    @property
+    def fingerprint(self):
+        """
+        由每行的内容哈希、标签和所属组计算的指纹，语料内容变化时随之变化。
+        """
+        return self.meta['fingerprint']
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get_code(self, i):
+        return self.code_blob[self.code_offsets[i]:self.code_offsets[i + 1]].decode('utf-8')
+
+    def get_path(self, i):
+        return self.path_blob[self.path_offsets[i]:self.path_offsets[i + 1]].decode('utf-8')
+
+    def get_hash(self, i):
+        return self.hashes[i].decode('ascii')
+
+    def __getitem__(self, i):
+        """
+        返回第 i 行，字段与 tot_data.jsonl 中的记录一致。
+        """
+        return {
+            "code": self.get_code(i),
+            "label": int(self.labels[i]),
+            "path": self.get_path(i),
+            "hash": self.get_hash(i),
+            "group": self.get_path(self.groups[i]),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def build_corpus_store(records, store_dir):
+    """
+    将记录流式写入列式语料库，内存中只保留偏移、标签和哈希等定长信息。
+
+    参数:
+        records (iterable): 含 code、label 的dict，可选 path、hash（缺失时 hash 由 code 计算）
+            和 group（近似重复组代表的 path，缺失时自成一组）。
+        store_dir (str): 输出目录，已存在时会被替换。
+
+    返回:
+        CorpusStore: 打开的语料库。
+    """
+    tmp_dir = store_dir.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    code_offsets = array('q', [0])
+    path_offsets = array('q', [0])
+    labels = array('q')
+    groups = array('q')
+    rows_by_path = {}
+    hashes = []
+    fingerprint = hashlib.sha1()
+    with open(os.path.join(tmp_dir, 'code.bin'), 'wb') as code_file, \
+            open(os.path.join(tmp_dir, 'path.bin'), 'wb') as path_file:
+        for record in records:
+            code = record['code'].encode('utf-8')
+            path = (record.get('path') or '').encode('utf-8')
+            code_hash = record.get('hash') or hashlib.sha1(code).hexdigest()
+            code_file.write(code)
+            path_file.write(path)
+            code_offsets.append(code_offsets[-1] + len(code))
+            path_offsets.append(path_offsets[-1] + len(path))
+            row = len(labels)
+            labels.append(record['label'])
+            hashes.append(code_hash.encode('ascii'))
+            if record.get('path'):
+                rows_by_path[record['path']] = row
+            # 组代表总是先于组内其他文件写出
+            groups.append(rows_by_path.get(record.get('group'), row))
+            fingerprint.update(f"{code_hash}:{record['label']}:{groups[-1]}\n".encode('ascii'))
+
+    np.save(os.path.join(tmp_dir, 'code_offsets.npy'), np.frombuffer(code_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'path_offsets.npy'), np.frombuffer(path_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.frombuffer(labels, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, 'hashes.npy'), np.array(hashes, dtype='S40'))
+    np.save(os.path.join(tmp_dir, 'groups.npy'), np.frombuffer(groups, dtype=np.int64))
+    meta = {'version': STORE_VERSION, 'num_records': len(labels), 'fingerprint': fingerprint.hexdigest()}
+    with open(os.path.join(tmp_dir, META_NAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(store_dir):
+        # 只覆盖之前写出的语料库目录，避免误删其他数据
+        if not is_corpus_store(store_dir):
+            raise FileExistsError(f"'{store_dir}' exists and is not a corpus store.")
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+    return CorpusStore(store_dir)
+
+
+if __name__ == '__main__':
+    # 将已有的 tot_data.jsonl（或分片目录）转换为列式语料库
+    from corpus_io import iter_jsonl
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default='../tot_data.jsonl', type=str)
+    parser.add_argument("--output", default='../tot_data.store', type=str)
+    args = parser.parse_args()
+    store = build_corpus_store(iter_jsonl(args.input), args.output)
+    print(f"Corpus store saved to {args.output} ({len(store)} records)")
@@ -3,12 +3,35 @@ import os
 import random
 from collections import defaultdict
 
+import numpy as np
+
+from corpus_io import iter_records
+
+def group_by_label(records):
+    """
+    将记录按近似重复组（group 字段）聚合，没有 group 字段的记录自成一组，
+    再按label归类。组按 (label, group) 区分，不同label的记录不会合并到同一组。
+
+    返回:
+        dict: label -> [组内记录列表, ...]，保持记录的出现顺序
+    """
+    groups = {}
+    for i, record in enumerate(records):
+        group = record.get('group')
+        groups.setdefault((record['label'], group) if group else i, []).append(record)
+
+    groups_by_label = defaultdict(list)
+    for members in groups.values():
+        groups_by_label[members[0]['label']].append(members)
+    return groups_by_label
+
 def split_data(input_jsonl, output_dir,time, num_folds=4):
     """
     从输入的jsonl文件中读取数据，并按k折交叉验证的方式划分数据集。
+    带 group 字段（pre_data --dedup）的近似重复文件整组划分到同一折。
 
     参数:
-        input_jsonl (str): 输入的jsonl文件路径
+        input_jsonl (str): 输入的jsonl文件路径，或 pre_data 写出的分片目录 / 列式语料库
         output_dir (str): 输出文件夹路径，将在该文件夹中保存训练和验证集文件
         num_folds (int): 折数（默认为4）
 
@@ -19,27 +42,22 @@ def split_data(input_jsonl, output_dir,time, num_folds=4):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    # 创建存储数据的字典，以label为键
-    data_by_label = defaultdict(list)
-
-    # 读取输入jsonl文件
-    with open(input_jsonl, 'r', encoding='utf-8') as f:
-        for line in f:
-            json_obj = json.loads(line.strip())
-            label = json_obj['label']
-            data_by_label[label].append(json_obj)
+    # 读取输入jsonl文件（或分片目录、列式语料库），按label将近似重复组放在一起
+    groups_by_label = group_by_label(iter_records(input_jsonl))
 
     # 创建存储每个折的数据
     folds = [[] for _ in range(num_folds)]
 
     # 将每个标签的数据分到各个折中
-    for label, items in data_by_label.items():
-        random.shuffle(items)
-        fold_size = len(items) // num_folds
-        for i in range(num_folds):
-            start = i * fold_size
-            end = start + fold_size if i < num_folds - 1 else len(items)
-            folds[i].extend(items[start:end])
+    for label, groups in groups_by_label.items():
+        random.shuffle(groups)
+        fold_size = sum(len(members) for members in groups) // num_folds
+        # 按组依次填充各折，每折 fold_size 条，余下的进入最后一折
+        count = 0
+        for members in groups:
+            fold = min(count // fold_size, num_folds - 1) if fold_size else num_folds - 1
+            folds[fold].extend(members)
+            count += len(members)
 
     # 保存每个折的数据集
     for fold in range(num_folds):
@@ -65,6 +83,37 @@ def split_data(input_jsonl, output_dir,time, num_folds=4):
 
     print(f"Data split completed into {num_folds} folds.")
 
+def split_data_ids(ids, labels, rng, num_folds=4, groups=None):
+    """
+    与 split_data 相同的按标签分层、以近似重复组为单位的 k 折划分，但只处理列式语料库中的行号，不复制数据。
+
+    参数:
+        ids (np.ndarray): 参与划分的行号
+        labels (np.ndarray): 整个语料库的标签数组
+        rng (np.random.Generator): 随机数生成器
+        num_folds (int): 折数（默认为4）
+        groups (np.ndarray, 可选): 每行所属组代表的行号，默认每行自成一组
+
+    返回:
+        list: 每折的 (train_ids, valid_ids)
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if groups is None:
+        groups = np.arange(len(labels))
+    id_groups = groups[ids]
+    representatives, sizes = np.unique(id_groups, return_counts=True)
+
+    representative_folds = np.empty(len(representatives), dtype=np.int64)
+    for label in np.unique(labels[representatives]):
+        index = rng.permutation(np.flatnonzero(labels[representatives] == label))
+        label_sizes = sizes[index]
+        starts = np.cumsum(label_sizes) - label_sizes
+        fold_size = label_sizes.sum() // num_folds
+        representative_folds[index] = np.minimum(starts // fold_size, num_folds - 1) if fold_size else num_folds - 1
+
+    id_folds = representative_folds[np.searchsorted(representatives, id_groups)]
+    return [(ids[id_folds != fold], ids[id_folds == fold]) for fold in range(num_folds)]
+
 # 示例调用
 if __name__ == '__main__':
     input_jsonl = '../data/data.jsonl'  # 修改为实际输入文件路径
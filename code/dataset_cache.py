@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from corpus_io import ID_SPLIT_SUFFIX, source_fingerprint
+from token_cache import tokenizer_fingerprint
+
+# 缓存格式或特征构建方式变化时递增，旧缓存随之失效
+DATASET_CACHE_VERSION = 1
+META_NAME = 'meta.json'
+ARRAY_NAMES = ('input_ids', 'lengths', 'labels')
+
+
+def dataset_cache_dir(file_path):
+    """
+    数据文件对应的缓存目录：与数据文件同目录的 dataset_cache/<文件名去掉后缀>，
+    不同的数据文件（例如各 fold 的训练集与整个训练集）不会共用同一个缓存。
+    """
+    name = os.path.basename(file_path.rstrip(os.sep))
+    for suffix in (ID_SPLIT_SUFFIX, '.jsonl'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), 'dataset_cache', name)
+
+
+def dataset_fingerprint(file_path, tokenizer, block_size, variant=''):
+    """
+    由缓存版本、数据内容、分词器、block_size 和预处理方式计算数据集指纹，任一变化都会使缓存失效。
+    """
+    key = f"{DATASET_CACHE_VERSION}:{source_fingerprint(file_path)}:{tokenizer_fingerprint(tokenizer)}:{block_size}"
+    if variant:
+        key += f":{variant}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def load_dataset_cache(cache_dir, fingerprint):
+    """
+    以 mmap（写时复制）方式加载缓存的数组。
+
+    返回:
+        dict: {'input_ids', 'lengths', 'labels'}；缓存不存在、版本或指纹不符时返回 None。
+    """
+    meta_path = os.path.join(cache_dir, META_NAME)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != DATASET_CACHE_VERSION or meta.get('fingerprint') != fingerprint:
+        return None
+    # 'c' 模式得到可写的视图（写入不会落盘），torch.from_numpy 不会因只读数组告警
+    return {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='c') for name in ARRAY_NAMES}
+
+
+def save_dataset_cache(cache_dir, fingerprint, arrays):
+    """
+    原子地写出数据集缓存：先写入临时目录，再整体替换旧缓存。
+
+    参数:
+        cache_dir (str): 缓存目录。
+        fingerprint (str): dataset_fingerprint 计算的指纹。
+        arrays (dict): {'input_ids', 'lengths', 'labels'} 对应的 numpy 数组。
+    """
+    tmp_dir = cache_dir.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+    meta = {'version': DATASET_CACHE_VERSION, 'fingerprint': fingerprint, 'num_examples': len(arrays['labels'])}
+    with open(os.path.join(tmp_dir, META_NAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
@@ -0,0 +1,375 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+from torch import nn
+
+from episode_loader import trim_padding
+
+logger = logging.getLogger(__name__)
+
+# 嵌入的计算方式变化时递增，旧缓存随之失效
+EMBEDDING_CACHE_VERSION = 1
+# 影响 backbone 输出的非参数设置（见 CustomBackbone、HierarchicalBackbone）
+_BACKBONE_SETTINGS = ('pad_token_id', 'chunk_size', 'pooling')
+
+
+def backbone_fingerprint(backbone, input_width=None):
+    """
+    由 backbone 的结构、影响输出的设置和全部权重计算指纹。
+    冻结的 backbone 在各 time、fold 中都从同一个预训练模型加载，指纹相同、共享同一份缓存。
+    backbone 不屏蔽填充（没有 pad_token_id）时 CLS 会关注填充，嵌入随输入宽度变化，
+    此时 input_width（编码时每行的 token 数）也计入指纹，不同 block_size 的嵌入不会互相复用。
+    """
+    sha1 = hashlib.sha1(f"{EMBEDDING_CACHE_VERSION}".encode('utf-8'))
+    if getattr(backbone, 'pad_token_id', None) is None:
+        sha1.update(f"width:{input_width}".encode('utf-8'))
+    for name, module in backbone.named_modules():
+        settings = {key: getattr(module, key) for key in _BACKBONE_SETTINGS if hasattr(module, key)}
+        sha1.update(f"{name}:{type(module).__name__}:{sorted(settings.items())}".encode('utf-8'))
+    for name, tensor in sorted(backbone.state_dict().items()):
+        sha1.update(name.encode('utf-8'))
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def _row_hash(ids):
+    return hashlib.sha1(np.ascontiguousarray(ids, dtype=np.int32).tobytes()).hexdigest()
+
+
+class EmbeddingCache(object):
+    """
+    按 token id 内容寻址的 CLS 嵌入缓存，键为 (去掉填充的 token id, backbone 指纹)。
+    每个 backbone 指纹对应 cache_dir 下的一个 sqlite 文件，与 TokenCache 的组织方式相同。
+    """
+    def __init__(self, cache_dir, fingerprint):
+        """
+        参数:
+            cache_dir (str): 缓存目录。
+            fingerprint (str): backbone_fingerprint 计算的指纹。
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, fingerprint[:16] + '.sqlite')
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def get_many(self, hashes):
+        """
+        返回 {hash: 嵌入(np.float32 数组)}，只包含已缓存的哈希。
+        """
+        found = {}
+        unique = list(set(hashes))
+        # sqlite 对单条语句的参数个数有限制，分批查询
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT hash, vector FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+            for row_hash, vector in rows:
+                found[row_hash] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, items):
+        """
+        写入 (hash, 嵌入) 序列。
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, vector) VALUES (?, ?)",
+            ((row_hash, np.asarray(vector, dtype=np.float32).tobytes()) for row_hash, vector in items))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def dataset_embeddings(backbone, dataset, cache, batch_size=64, device=None):
+    """
+    计算数据集中每个样本的 CLS 嵌入：先查询缓存，只对未缓存的样本（去重后）按长度排序、大批量编码并写回缓存。
+    backbone 屏蔽填充（设置了 pad_token_id）时每批只填充到其中最长的序列，结果不变。
+
+    参数:
+        backbone: 冻结的 CustomBackbone 或 HierarchicalBackbone。
+        dataset: FewShotTextDataset 或包装它的 WrapFewShotDataset。
+        cache (EmbeddingCache): 与 backbone 指纹对应的缓存。
+        batch_size (int): 编码的批大小。
+        device: 编码使用的设备。
+
+    返回:
+        np.ndarray: 形状为 (样本数, hidden_size) 的 float32 矩阵，行顺序与数据集一致。
+    """
+    source = getattr(dataset, 'source_dataset', dataset)
+    hashes = [_row_hash(source.input_ids[i, :source.lengths[i]]) for i in range(len(source))]
+    known = cache.get_many(hashes)
+    missing = {}
+    for i, row_hash in enumerate(hashes):
+        if row_hash not in known:
+            missing.setdefault(row_hash, i)
+
+    pad_token_id = getattr(backbone, 'pad_token_id', None)
+    order = sorted(missing.values(), key=lambda i: source.lengths[i])
+    was_training = backbone.training
+    backbone.eval()
+    try:
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                indices = order[start:start + batch_size]
+                batch = torch.from_numpy(source.input_ids[indices]).long()
+                if pad_token_id is not None:
+                    batch = trim_padding(batch, pad_token_id)
+                vectors = backbone(batch.to(device)).float().cpu().numpy()
+                items = [(hashes[i], vector) for i, vector in zip(indices, vectors)]
+                cache.put_many(items)
+                known.update(items)
+    finally:
+        backbone.train(was_training)
+    logger.info("Embedding cache: %d snippets cached, %d encoded", len(set(hashes)) - len(missing), len(missing))
+    return np.stack([known[row_hash] for row_hash in hashes]).astype(np.float32)
+
+
+def bottom_layers_fingerprint(backbone, num_layers):
+    """
+    只由 embedding 层和底部 num_layers 层的权重（以及 pad_token_id）计算指纹：
+    上层的训练不影响缓存的隐藏状态，训练与测试（加载训练后的 checkpoint）共享同一份缓存。
+    """
+    sha1 = hashlib.sha1(f"{EMBEDDING_CACHE_VERSION}:{num_layers}:{backbone.pad_token_id}".encode('utf-8'))
+    prefixes = ('original_backbone.embeddings.',) + tuple(
+        f'original_backbone.encoder.layer.{i}.' for i in range(num_layers))
+    for name, tensor in sorted(backbone.state_dict().items()):
+        if name.startswith(prefixes):
+            sha1.update(name.encode('utf-8'))
+            sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class HiddenStateCache(object):
+    """
+    按 token id 内容寻址的中间层隐藏状态缓存（--freeze_layers）。
+    cache_dir/<指纹> 下的 states.bin 是追加写入的 float16 矩阵（总 token 数, hidden_size），
+    每个样本只保存真实 token 的部分；index.sqlite 记录 hash -> (起始行, 长度)。
+    先写数据再提交索引，中断时索引不会指向不完整的数据。读取时以 np.memmap 映射，不载入内存。
+    """
+    def __init__(self, cache_dir, fingerprint, hidden_size):
+        """
+        参数:
+            cache_dir (str): 缓存目录。
+            fingerprint (str): bottom_layers_fingerprint 计算的指纹。
+            hidden_size (int): 隐藏状态的维度。
+        """
+        self.directory = os.path.join(cache_dir, fingerprint[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.hidden_size = hidden_size
+        self.states_path = os.path.join(self.directory, 'states.bin')
+        self.connection = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS states (hash TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+
+    def get_many(self, hashes):
+        """
+        返回 {hash: (起始行, 长度)}，只包含已缓存的哈希。
+        """
+        found = {}
+        unique = list(set(hashes))
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT hash, offset, length FROM states WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+            for row_hash, offset, length in rows:
+                found[row_hash] = (offset, length)
+        return found
+
+    def append(self, items):
+        """
+        追加 (hash, 隐藏状态(长度, hidden_size)) 序列。
+
+        返回:
+            dict: {hash: (起始行, 长度)}。
+        """
+        positions = {}
+        with open(self.states_path, 'ab') as f:
+            offset = f.tell() // (self.hidden_size * 2)
+            for row_hash, states in items:
+                f.write(np.ascontiguousarray(states, dtype=np.float16).tobytes())
+                positions[row_hash] = (offset, len(states))
+                offset += len(states)
+        self.connection.executemany("INSERT OR REPLACE INTO states (hash, offset, length) VALUES (?, ?, ?)",
+                                    ((row_hash, offset, length) for row_hash, (offset, length) in positions.items()))
+        self.connection.commit()
+        return positions
+
+    def open_states(self):
+        """
+        以只读 memmap 打开全部隐藏状态，形状为 (总 token 数, hidden_size)。
+        """
+        return np.memmap(self.states_path, dtype=np.float16, mode='r').reshape(-1, self.hidden_size)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def dataset_hidden_states(backbone, dataset, cache, num_layers, batch_size=64, device=None):
+    """
+    计算数据集中每个样本第 num_layers 层的隐藏状态并写入 HiddenStateCache，只编码未缓存的样本。
+
+    返回:
+        np.ndarray: 形状为 (样本数, 2) 的 int64 矩阵，每行为样本在缓存中的 (起始行, 长度)。
+    """
+    source = getattr(dataset, 'source_dataset', dataset)
+    hashes = [_row_hash(source.input_ids[i, :source.lengths[i]]) for i in range(len(source))]
+    known = cache.get_many(hashes)
+    missing = {}
+    for i, row_hash in enumerate(hashes):
+        if row_hash not in known:
+            missing.setdefault(row_hash, i)
+
+    order = sorted(missing.values(), key=lambda i: source.lengths[i])
+    was_training = backbone.training
+    backbone.eval()
+    try:
+        with torch.no_grad():
+            for start in range(0, len(order), batch_size):
+                indices = order[start:start + batch_size]
+                batch = trim_padding(torch.from_numpy(source.input_ids[indices]).long(), backbone.pad_token_id)
+                states, attention_mask = backbone.bottom_hidden_states(batch.to(device), num_layers)
+                lengths = attention_mask.sum(dim=1).tolist()
+                states = states.cpu().numpy()
+                known.update(cache.append(
+                    (hashes[i], states[j, :lengths[j]]) for j, i in enumerate(indices)))
+    finally:
+        backbone.train(was_training)
+    logger.info("Hidden-state cache: %d snippets cached, %d encoded", len(set(hashes)) - len(missing), len(missing))
+    return np.array([known[row_hash] for row_hash in hashes], dtype=np.int64).reshape(-1, 2)
+
+
+class TopLayersBackbone(nn.Module):
+    """
+    --freeze_layers 训练时代替 FEAT 的 backbone：输入为每个样本在 HiddenStateCache 中的 (起始行, 长度)，
+    从 memmap 中取出第 K 层的隐藏状态，只运行 CustomBackbone 的上层得到 CLS 嵌入。
+    与原 backbone 共享参数，优化器更新的就是原 backbone 的上层。
+    """
+    def __init__(self, backbone, states, num_layers):
+        super(TopLayersBackbone, self).__init__()
+        self.backbone = backbone
+        self.states = states
+        self.num_layers = num_layers
+
+    def forward(self, rows):
+        positions = rows.tolist()
+        width = max(length for _, length in positions)
+        hidden_states = torch.zeros(len(positions), width, self.states.shape[1])
+        attention_mask = torch.zeros(len(positions), width, dtype=torch.long)
+        for i, (offset, length) in enumerate(positions):
+            hidden_states[i, :length] = torch.from_numpy(np.asarray(self.states[offset:offset + length], dtype=np.float32))
+            attention_mask[i, :length] = 1
+        device = rows.device
+        return self.backbone.top_layers_cls(hidden_states.to(device), attention_mask.to(device), self.num_layers)
+
+
+def freeze_bottom_layers(model, num_layers):
+    """
+    冻结 FEAT 的 backbone 中的 embedding 层和底部 num_layers 层，只训练上层和注意力模块。
+    """
+    roberta = model.backbone.original_backbone
+    for module in [roberta.embeddings] + list(roberta.encoder.layer[:num_layers]):
+        for parameter in module.parameters():
+            parameter.requires_grad_(False)
+
+
+def freeze_backbone(model):
+    """
+    冻结 FEAT 的 backbone：不再计算梯度，并固定在 eval 模式（关闭 dropout）。
+    """
+    for parameter in model.backbone.parameters():
+        parameter.requires_grad_(False)
+    model.backbone.eval()
+
+
+@contextmanager
+def cached_features(model):
+    """
+    在该上下文中用 nn.Identity 代替 FEAT 的 backbone，episode 直接提供缓存的 CLS 嵌入
+    （与 easyfsl 在预先提取的特征上使用 FEAT 的方式相同）。退出时恢复 backbone，保存的 checkpoint 不受影响。
+    """
+    backbone = model.backbone
+    model.backbone = nn.Identity()
+    try:
+        yield model
+    finally:
+        model.backbone = backbone
+
+
+@contextmanager
+def cached_hidden_states(model, states, num_layers):
+    """
+    在该上下文中用 TopLayersBackbone 代替 FEAT 的 backbone，episode 提供隐藏状态在缓存中的位置。
+    退出时恢复 backbone，保存的 checkpoint 不受影响。
+    """
+    backbone = model.backbone
+    model.backbone = TopLayersBackbone(backbone, states, num_layers)
+    try:
+        yield model
+    finally:
+        model.backbone = backbone
+
+
+def backbone_mode(args, model, states=None):
+    """
+    args.freeze_backbone 时返回 cached_features(model)（episode 中是缓存的嵌入），
+    args.freeze_layers 大于 0 时返回 cached_hidden_states（states 为 compute_hidden_states 打开的 memmap），
+    否则不做任何替换。
+    """
+    if args.freeze_backbone:
+        return cached_features(model)
+    if args.freeze_layers > 0:
+        return cached_hidden_states(model, states, args.freeze_layers)
+    return nullcontext(model)
+
+
+def compute_embeddings(args, model, datasets):
+    """
+    用 FEAT 中冻结的 backbone 计算各数据集的 CLS 嵌入，缓存在 args.embedding_cache_dir 中。
+
+    参数:
+        args: 命令行参数（使用 embedding_cache_dir、embedding_batch_size、device）。
+        model: FEAT 模型。
+        datasets (dict): 名称到数据集的映射。
+
+    返回:
+        dict: 名称到 (样本数, hidden_size) float32 矩阵的映射。
+    """
+    input_width = args.block_size * getattr(args, 'max_chunks', 1)
+    with EmbeddingCache(args.embedding_cache_dir, backbone_fingerprint(model.backbone, input_width)) as cache:
+        return {name: dataset_embeddings(model.backbone, dataset, cache, batch_size=args.embedding_batch_size,
+                                         device=args.device)
+                for name, dataset in datasets.items()}
+
+
+def compute_hidden_states(args, model, datasets):
+    """
+    用 FEAT 的 backbone 中冻结的底部 args.freeze_layers 层计算各数据集的隐藏状态，缓存在 args.hidden_cache_dir 中。
+
+    返回:
+        (dict, np.memmap): 名称到 (样本数, 2) 位置矩阵的映射，以及全部隐藏状态的 memmap。
+    """
+    backbone = model.backbone
+    fingerprint = bottom_layers_fingerprint(backbone, args.freeze_layers)
+    hidden_size = backbone.original_backbone.config.hidden_size
+    with HiddenStateCache(args.hidden_cache_dir, fingerprint, hidden_size) as cache:
+        positions = {name: dataset_hidden_states(backbone, dataset, cache, args.freeze_layers,
+                                                 batch_size=args.embedding_batch_size, device=args.device)
+                     for name, dataset in datasets.items()}
+        return positions, cache.open_states()
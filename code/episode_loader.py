@@ -0,0 +1,387 @@
+import logging
+import queue
+import random
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from easyfsl.samplers import TaskSampler
+
+logger = logging.getLogger(__name__)
+
+
+def episodic_collate(input_data, n_way, n_shot, n_query):
+    """
+    与 easyfsl TaskSampler.episodic_collate_fn 相同的组装逻辑，但只依赖任务形状，
+    不需要把整个采样器序列化到 worker 中。
+
+    参数:
+        input_data (list): (token id 张量, 标签) 列表，按类别依次排列，每类 n_shot + n_query 个。
+        n_way, n_shot, n_query (int): 任务形状。
+
+    返回:
+        tuple: (support_images, support_labels, query_images, query_labels, true_class_ids)
+    """
+    input_data = [(image, int(label)) for image, label in input_data]
+    true_class_ids = list({x[1] for x in input_data})
+    all_images = torch.cat([x[0].unsqueeze(0) for x in input_data])
+    all_images = all_images.reshape((n_way, n_shot + n_query, *all_images.shape[1:]))
+    all_labels = torch.tensor(
+        [true_class_ids.index(x[1]) for x in input_data]
+    ).reshape((n_way, n_shot + n_query))
+    support_images = all_images[:, :n_shot].reshape((-1, *all_images.shape[2:]))
+    query_images = all_images[:, n_shot:].reshape((-1, *all_images.shape[2:]))
+    support_labels = all_labels[:, :n_shot].flatten()
+    query_labels = all_labels[:, n_shot:].flatten()
+    return support_images, support_labels, query_images, query_labels, true_class_ids
+
+
+def trim_padding(images, pad_token_id):
+    """
+    去掉一批 token id 末尾所有样本都是填充的列，即只填充到这批中最长的序列。
+    配合 attention mask 使用时结果与填充到 block_size 完全一致。
+    """
+    non_pad = (images != pad_token_id).any(dim=0).nonzero()
+    length = int(non_pad[-1]) + 1 if len(non_pad) else 1
+    return images[:, :length]
+
+
+def pad_to_width(images, pad_token_id):
+    """
+    把分别裁剪过填充的若干组 token id 用 pad_token_id 补齐到相同宽度，以便拼接后一起送入 backbone。
+    pad_token_id 为 None（episode 未裁剪，或 episode 中是缓存的嵌入、隐藏状态位置，见 concat_pad_token_id）时
+    原样返回，宽度不同时由拼接报错；浮点特征在任何情况下都不会用 pad id 填充。
+    """
+    if pad_token_id is None or any(image.is_floating_point() for image in images) \
+            or len({image.shape[1] for image in images}) <= 1:
+        return list(images)
+    width = max(image.shape[1] for image in images)
+    return [torch.nn.functional.pad(image, (0, width - image.shape[1]), value=pad_token_id) for image in images]
+
+
+def group_episodes(data_loader, group_size):
+    """
+    把 data_loader 产出的 episode 按 group_size 个一组产出（最后一组可能不足），
+    用于 --train_batch_size / --eval_batch_size 把多个 episode 合并为一次 backbone 前向。
+    """
+    group = []
+    for episode in data_loader:
+        group.append(episode)
+        if len(group) == group_size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def trim_episode(episode, pad_token_id):
+    """
+    对 episode 的支持集和查询集分别做 trim_padding（FEAT 对二者分别调用 backbone）。
+    pad_token_id 为 None 时原样返回。
+    """
+    if pad_token_id is None:
+        return episode
+    support_images, support_labels, query_images, query_labels, true_class_ids = episode
+    return (trim_padding(support_images, pad_token_id), support_labels,
+            trim_padding(query_images, pad_token_id), query_labels, true_class_ids)
+
+
+class TrimmedCollate(object):
+    """
+    包装 DataLoader 的 collate_fn，组装后按 episode 裁掉多余的填充。可以被序列化到 spawn 的 worker 中。
+    """
+    def __init__(self, collate_fn, pad_token_id):
+        self.collate_fn = collate_fn
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, input_data):
+        return trim_episode(self.collate_fn(input_data), self.pad_token_id)
+
+
+class LengthBucketTaskSampler(TaskSampler):
+    """
+    按长度分桶的任务采样器：每个类别的样本按 token 长度排序后切成 num_buckets 个连续的桶，
+    每个任务随机选一个桶的序号，各类别都从自己对应序号的桶中采样。
+    同一 episode 内的序列长度相近，配合动态填充可以减少填充的 token。
+    每个桶至少包含 n_shot + n_query 个样本，样本不足的类别使用更少的桶。
+    """
+    def __init__(self, dataset, n_way, n_shot, n_query, n_tasks, lengths, num_buckets):
+        """
+        参数:
+            dataset: 实现了 get_labels() 的数据集（如 WrapFewShotDataset）。
+            n_way, n_shot, n_query, n_tasks (int): 与 TaskSampler 相同。
+            lengths (array): 每个样本的 token 长度（FewShotTextDataset.lengths）。
+            num_buckets (int): 每个类别的桶数。
+        """
+        super().__init__(dataset, n_way=n_way, n_shot=n_shot, n_query=n_query, n_tasks=n_tasks)
+        self.num_buckets = num_buckets
+        self.buckets_per_label = {}
+        for label, items in self.items_per_label.items():
+            items = sorted(items, key=lambda item: lengths[item])
+            count = max(1, min(num_buckets, len(items) // (n_shot + n_query)))
+            self.buckets_per_label[label] = [items[len(items) * b // count:len(items) * (b + 1) // count]
+                                             for b in range(count)]
+
+    def __iter__(self):
+        for _ in range(self.n_tasks):
+            # 桶的相对位置在各类别间共用，桶数不同的类别按比例换算
+            position = random.random()
+            indices = []
+            for label in random.sample(sorted(self.items_per_label.keys()), self.n_way):
+                buckets = self.buckets_per_label[label]
+                bucket = buckets[int(position * len(buckets))]
+                indices.extend(random.sample(bucket, self.n_shot + self.n_query))
+            yield indices
+
+
+def make_task_sampler(args, dataset, n_tasks):
+    """
+    args.length_buckets 大于 0 时返回 LengthBucketTaskSampler，否则返回 easyfsl 的 TaskSampler。
+    """
+    if getattr(args, 'length_buckets', 0) > 0:
+        lengths = getattr(dataset, 'source_dataset', dataset).lengths
+        return LengthBucketTaskSampler(dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query,
+                                       n_tasks=n_tasks, lengths=lengths, num_buckets=args.length_buckets)
+    return TaskSampler(dataset, n_way=args.n_way, n_shot=args.n_shot, n_query=args.n_query, n_tasks=n_tasks)
+
+
+def _episode_worker(datasets, task_queue, result_queue, pad_token_id=None):
+    # 每个 worker 只组装 episode，单线程即可，避免与主进程的模型计算争抢 CPU
+    torch.set_num_threads(1)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        seq, name, indices, shape = task
+        try:
+            dataset = datasets[name]
+            episode = trim_episode(episodic_collate([dataset[i] for i in indices], *shape), pad_token_id)
+            result_queue.put((seq, episode, None))
+        except Exception:
+            result_queue.put((seq, None, traceback.format_exc()))
+
+
+class EpisodeStream(object):
+    """
+    带长度的 episode 迭代器，供 tqdm 显示进度。
+    """
+    def __init__(self, iterator, length):
+        self.iterator = iterator
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterator
+
+
+class EpisodePipeline(object):
+    """
+    常驻的 episode 预取进程池。进程在一个 fold 的所有 epoch 中保持存活，
+    同时为训练采样器和验证采样器服务，避免每个 epoch 重新 spawn DataLoader worker
+    （每次都要重新导入 torch/transformers）。
+
+    数据集在进程启动时传入一次（FewShotTextDataset 位于共享内存中，只传递句柄），
+    之后每个任务只发送样本下标。
+    """
+    def __init__(self, datasets, num_workers=4, prefetch_depth=8, pad_token_id=None):
+        """
+        参数:
+            datasets (dict): 名称到数据集（如 WrapFewShotDataset）的映射，例如 {'train': ..., 'valid': ...}。
+            num_workers (int): worker 进程数。
+            prefetch_depth (int): 同时在途（已提交、尚未取走）的 episode 数上限。
+            pad_token_id (int): 设置时各 episode 只填充到其中最长的序列（见 trim_episode）。
+        """
+        if num_workers <= 0:
+            raise ValueError(f"EpisodePipeline needs at least one worker, got num_workers={num_workers}.")
+        self.prefetch_depth = max(prefetch_depth, 1)
+        self.stall_time = 0.0
+        self._next_seq = 0
+        context = mp.get_context('spawn')
+        self._task_queue = context.Queue()
+        self._result_queue = context.Queue()
+        self._workers = [
+            context.Process(target=_episode_worker, daemon=True,
+                            args=(datasets, self._task_queue, self._result_queue, pad_token_id))
+            for _ in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _get_result(self):
+        # 带超时地等待，worker 异常退出时报错而不是一直阻塞
+        while True:
+            try:
+                return self._result_queue.get(timeout=5)
+            except queue.Empty:
+                dead = [worker.pid for worker in self._workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Episode worker(s) {dead} exited unexpectedly.")
+
+    def episodes(self, name, sampler):
+        """
+        按采样器的顺序产出数据集 name 上的 episode，worker 最多提前准备 prefetch_depth 个。
+        返回值可以像 DataLoader 一样直接用于 enumerate 和 len。
+
+        参数:
+            name (str): 构造时传入的数据集名称。
+            sampler: 产出下标列表的任务采样器（如 TaskSampler），需有 n_way、n_shot、n_query 属性。
+
+        返回:
+            EpisodeStream: 依次产出 (support_images, support_labels, query_images, query_labels, true_class_ids)。
+            迭代结束时 self.stall_time 为本次等待 worker 的总时间。
+        """
+        return EpisodeStream(self._iter_episodes(name, sampler), len(sampler))
+
+    def _iter_episodes(self, name, sampler):
+        shape = (sampler.n_way, sampler.n_shot, sampler.n_query)
+        tasks = iter(sampler)
+        # 序号全局递增，之前被中断的迭代留下的结果会被丢弃
+        first_seq = self._next_seq
+        in_flight = 0
+        pending = {}
+        self.stall_time = 0.0
+
+        def submit():
+            indices = next(tasks, None)
+            if indices is None:
+                return False
+            self._task_queue.put((self._next_seq, name, list(indices), shape))
+            self._next_seq += 1
+            return True
+
+        while in_flight < self.prefetch_depth and submit():
+            in_flight += 1
+        expected = first_seq
+        num_episodes = 0
+        while in_flight:
+            while expected not in pending:
+                start = time.perf_counter()
+                seq, episode, error = self._get_result()
+                self.stall_time += time.perf_counter() - start
+                if seq < first_seq:
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Episode worker failed:\n{error}")
+                pending[seq] = episode
+            episode = pending.pop(expected)
+            expected += 1
+            in_flight -= 1
+            if submit():
+                in_flight += 1
+            num_episodes += 1
+            yield episode
+        logger.info("Episode pipeline (%s): %d episodes, %.2fs waiting for workers", name, num_episodes,
+                    self.stall_time)
+
+    def close(self):
+        for _ in self._workers:
+            self._task_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TensorEpisodeGatherer(object):
+    """
+    进程内的 episode 组装：特征已经是一个 id 矩阵，episode 只是一次下标 gather，
+    用 index_select 取出支持集/查询集，并向量化地把数据集标签映射为 episode 内的 0..n_way-1，
+    不经过 worker 进程、序列化和 episodic_collate_fn。
+    与 EpisodePipeline 接口相同，可直接替换。
+    """
+    def __init__(self, datasets, pad_token_id=None, features=None):
+        """
+        参数:
+            datasets (dict): 名称到数据集的映射，数据集为 FewShotTextDataset 或包装它的 WrapFewShotDataset。
+            pad_token_id (int): 设置时各 episode 只填充到其中最长的序列。
+            features (dict): 可选的名称到特征矩阵（如 embedding_cache.dataset_embeddings 计算的 CLS 嵌入，
+                行顺序与数据集一致）的映射；给出时 episode 中是特征而不是 token id。
+        """
+        self.stall_time = 0.0
+        self.pad_token_id = pad_token_id
+        self._tensors = {}
+        features = features or {}
+        for name, dataset in datasets.items():
+            source = getattr(dataset, 'source_dataset', dataset)
+            # 与数据集共用内存（共享内存中的张量），不复制
+            inputs = torch.from_numpy(features[name] if name in features else source.input_ids)
+            self._tensors[name] = (inputs, torch.from_numpy(source.example_labels),
+                                   torch.from_numpy(source.lengths) if name not in features else None)
+
+    def gather(self, name, indices, n_way, n_shot, n_query):
+        """
+        组装一个 episode，输出格式与 episodic_collate 相同。
+        episode 内标签按类别 id 从小到大编号；与 episodic_collate 的编号顺序可能不同，
+        但支持集和查询集使用同一映射，分类结果不受影响。
+        """
+        input_ids, labels, lengths = self._tensors[name]
+        index = torch.as_tensor(indices, dtype=torch.long)
+        all_images = input_ids.index_select(0, index).reshape(n_way, n_shot + n_query, -1)
+        true_class_ids, all_labels = torch.unique(labels.index_select(0, index), return_inverse=True)
+        all_labels = all_labels.reshape(n_way, n_shot + n_query)
+        support_images = all_images[:, :n_shot].reshape(n_way * n_shot, -1)
+        query_images = all_images[:, n_shot:].reshape(n_way * n_query, -1)
+        if self.pad_token_id is not None and lengths is not None:
+            # 已知每个样本的长度，直接裁到支持集/查询集各自的最大长度
+            all_lengths = lengths.index_select(0, index).reshape(n_way, n_shot + n_query)
+            support_images = support_images[:, :int(all_lengths[:, :n_shot].max())]
+            query_images = query_images[:, :int(all_lengths[:, n_shot:].max())]
+        support_labels = all_labels[:, :n_shot].flatten()
+        query_labels = all_labels[:, n_shot:].flatten()
+        return support_images, support_labels, query_images, query_labels, true_class_ids.tolist()
+
+    def episodes(self, name, sampler):
+        shape = (sampler.n_way, sampler.n_shot, sampler.n_query)
+        return EpisodeStream((self.gather(name, indices, *shape) for indices in sampler), len(sampler))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_episode_pipeline(args, datasets):
+    """
+    按 args.episode_loader 创建常驻的 episode 来源：
+        inprocess  -> TensorEpisodeGatherer；
+        persistent -> EpisodePipeline（args.num_workers 为 0 时退回 DataLoader）；
+        dataloader -> None，由调用方每个 epoch 创建 DataLoader。
+    """
+    pad_token_id = episode_pad_token_id(args)
+    if args.episode_loader == 'inprocess':
+        return TensorEpisodeGatherer(datasets, pad_token_id=pad_token_id)
+    if args.episode_loader == 'persistent' and args.num_workers > 0:
+        return EpisodePipeline(datasets, num_workers=args.num_workers, prefetch_depth=args.prefetch_depth,
+                               pad_token_id=pad_token_id)
+    return None
+
+
+def episode_pad_token_id(args):
+    """
+    开启 --dynamic_padding 时返回用于裁剪 episode 的 pad_token_id，否则返回 None。
+    """
+    return args.pad_token_id if getattr(args, 'dynamic_padding', False) else None
+
+
+def concat_pad_token_id(args):
+    """
+    多组输入拼接后一起送入 backbone（--fused_episodes、--train_batch_size / --eval_batch_size）时，
+    用于把分别裁剪过的 token id 补齐到相同宽度的 pad_token_id。
+    episode 未裁剪，或其中是缓存的嵌入（--freeze_backbone）、隐藏状态位置（--freeze_layers）而不是 token id 时返回 None。
+    """
+    if getattr(args, 'freeze_backbone', False) or getattr(args, 'freeze_layers', 0) > 0:
+        return None
+    return episode_pad_token_id(args)
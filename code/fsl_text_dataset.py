@@ -1,62 +1,378 @@
+import copy
 import logging
+import multiprocessing
+import os
+import re
+from itertools import islice
+
+import numpy as np
 import torch
 from torch.utils.data import Dataset
-import json
 from transformers import RobertaModel, RobertaConfig
+from corpus_io import iter_records
+from dataset_cache import dataset_cache_dir, dataset_fingerprint, load_dataset_cache, save_dataset_cache
 from input_features import InputFeatures
+from relevance_slice import SLICER_VERSION, slice_relevant_code
+from token_cache import TokenCache, record_hash
 
 logger = logging.getLogger(__name__)
 
-def convert_examples_to_features(js, tokenizer, args):
-    # 将代码文本转换为 tokens
-    code = ' '.join(js['code'].split())
-    code_tokens = tokenizer.tokenize(code)[:args.block_size - 2]
+_WORD = re.compile(r'\S+')
+
+
+def _truncation_text(code, max_tokens):
+    """
+    返回分词前 max_tokens 个 token 所需的文本：代码开头的前 max_tokens 个词以空格连接。
+    RoBERTa 的预分词不会跨越空白，且每个以空白分隔的词至少产生一个 token，
+    因此前 max_tokens 个 token 一定来自前 max_tokens 个词，长文件的其余部分无需分词。
+    """
+    if max_tokens < 0:
+        # 负数按切片语义从末尾截断，只能对完整代码分词
+        return ' '.join(code.split())
+    return ' '.join(match.group() for match in islice(_WORD.finditer(code), max_tokens))
+
+
+def truncated_tokenize(code, tokenizer, max_tokens):
+    """
+    只对代码开头足以填满 max_tokens 的部分做 BPE 分词，结果与
+    tokenizer.tokenize(' '.join(code.split()))[:max_tokens] 完全一致。
+
+    参数:
+        code (str): 代码内容。
+        tokenizer: RobertaTokenizer（或同样按空白预分词的 BPE 分词器）。
+        max_tokens (int): 保留的 token 数。
+
+    返回:
+        list: 最多 max_tokens 个 token。
+    """
+    return tokenizer.tokenize(_truncation_text(code, max_tokens))[:max_tokens]
+
+
+def _build_features(code_tokens, code_ids, label, tokenizer, block_size):
+    # 加上 CLS/SEP 并填充到 block_size
     source_tokens = [tokenizer.cls_token] + code_tokens + [tokenizer.sep_token]
-    source_ids = tokenizer.convert_tokens_to_ids(source_tokens)
-    padding_length = args.block_size - len(source_ids)
+    source_ids = [tokenizer.cls_token_id] + code_ids + [tokenizer.sep_token_id]
+    padding_length = block_size - len(source_ids)
     source_ids += [tokenizer.pad_token_id] * padding_length
-    return InputFeatures(source_tokens, source_ids, js['label'])
+    return InputFeatures(source_tokens, source_ids, label)
+
+
+def convert_examples_to_features(js, tokenizer, args):
+    # 将代码文本转换为 tokens，只对填满 block_size 所需的开头部分分词
+    code_tokens = truncated_tokenize(js['code'], tokenizer, args.block_size - 2)
+    code_ids = tokenizer.convert_tokens_to_ids(code_tokens)
+    return _build_features(code_tokens, code_ids, js['label'], tokenizer, args.block_size)
+
+
+def convert_batch_to_features(records, tokenizer, block_size):
+    """
+    用快速分词器（RobertaTokenizerFast）一次性批量分词，结果与逐条调用
+    convert_examples_to_features 相同。
+
+    参数:
+        records (list): 含 code、label 的dict。
+        tokenizer: 快速分词器（tokenizer.is_fast 为 True）。
+        block_size (int): 输入序列长度。
+
+    返回:
+        list: InputFeatures 列表，顺序与 records 一致。
+    """
+    max_tokens = block_size - 2
+    encodings = tokenizer([_truncation_text(js['code'], max_tokens) for js in records],
+                          add_special_tokens=False, return_attention_mask=False)
+    features = []
+    for i, js in enumerate(records):
+        code_tokens = encodings.tokens(i)[:max_tokens]
+        code_ids = encodings['input_ids'][i][:max_tokens]
+        features.append(_build_features(code_tokens, code_ids, js['label'], tokenizer, block_size))
+    return features
+
+
+def _iter_batches(records, batch_size):
+    batch = []
+    for js in records:
+        batch.append(js)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_worker_tokenizer = None
+
+
+def _init_featurize_worker(tokenizer):
+    global _worker_tokenizer
+    # 每个进程只用单线程分词，避免与进程池争抢 CPU
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+
+
+def _featurize_batch(task):
+    batch, block_size = task
+    return convert_batch_to_features(batch, _worker_tokenizer, block_size)
+
+
+def featurize_records(records, tokenizer, block_size, num_workers=0, batch_size=512, pool=None):
+    """
+    流式地批量分词，可选地把各批分发到进程池。只有当前批次的代码保存在内存中。
+
+    参数:
+        records (iterable): 含 code、label 的dict。
+        tokenizer: 快速分词器。
+        block_size (int): 输入序列长度。
+        num_workers (int): 进程数，0 表示在当前进程中分词（快速分词器自身会多线程批量处理）。
+        batch_size (int): 每批的记录数。
+        pool (multiprocessing.Pool): 可选的已初始化进程池（见 _open_featurize_pool），传入时忽略 num_workers。
+
+    返回:
+        list: InputFeatures 列表，顺序与 records 一致。
+    """
+    if pool is None and num_workers <= 0:
+        return [feature for batch in _iter_batches(records, batch_size)
+                for feature in convert_batch_to_features(batch, tokenizer, block_size)]
+
+    tasks = ((batch, block_size) for batch in _iter_batches(records, batch_size))
+    if pool is not None:
+        # imap 保持批次顺序
+        return [feature for features in pool.imap(_featurize_batch, tasks) for feature in features]
+    with _open_featurize_pool(tokenizer, num_workers) as pool:
+        return [feature for features in pool.imap(_featurize_batch, tasks) for feature in features]
+
+
+def _open_featurize_pool(tokenizer, num_workers):
+    return multiprocessing.Pool(num_workers, initializer=_init_featurize_worker, initargs=(tokenizer,))
+
+
+def feature_variant(args):
+    """
+    分词前对代码的预处理方式，作为 token 缓存和数据集缓存键的一部分：'' 表示使用完整代码。
+    AST 切片带有切片规则的版本号，切片规则修改后旧的缓存不再命中。
+    """
+    return f'ast_slice:v{SLICER_VERSION}' if getattr(args, 'ast_slice', False) else ''
+
+
+def chunk_token_budget(block_size, max_chunks):
+    """
+    分块模式下一个文件最多保留的 token 数（含首尾的 CLS/SEP）：每块 block_size - 2 个代码 token。
+    """
+    return max_chunks * (block_size - 2) + 2
+
+
+def layout_chunks(source_ids, block_size, max_chunks, tokenizer):
+    """
+    把一个文件的 source_ids（CLS + 代码 + SEP）切成最多 max_chunks 块，每块为 CLS + 代码片段 + SEP，
+    填充到 block_size 后首尾相接。未使用的块全部为填充。
+
+    返回:
+        (np.ndarray, int): 长度为 max_chunks * block_size 的 int32 行，以及其中已使用的长度。
+    """
+    content = source_ids[1:-1]
+    step = block_size - 2
+    row = np.full(max_chunks * block_size, tokenizer.pad_token_id, dtype=np.int32)
+    length = 0
+    for chunk in range(max(1, -(-len(content) // step))):
+        piece = content[chunk * step:(chunk + 1) * step]
+        start = chunk * block_size
+        row[start] = tokenizer.cls_token_id
+        row[start + 1:start + 1 + len(piece)] = piece
+        row[start + 1 + len(piece)] = tokenizer.sep_token_id
+        length = start + len(piece) + 2
+    return row, length
+
+
+def _slice_records(records, pool=None):
+    # AST 切片只对需要分词的记录进行；有进程池时在进程池中解析
+    codes = [js['code'] for js in records]
+    sliced = pool.map(slice_relevant_code, codes, chunksize=64) if pool is not None else map(slice_relevant_code, codes)
+    return [dict(js, code=code) for js, code in zip(records, sliced)]
+
+
+def _featurize(records, tokenizer, args, pool=None):
+    if getattr(args, 'ast_slice', False):
+        records = _slice_records(records, pool=pool)
+    if getattr(tokenizer, 'is_fast', False):
+        # 快速分词器批量分词，可选多进程
+        return featurize_records(records, tokenizer, args.block_size, pool=pool)
+    # return [convert_examples_to_features(js, tokenizer, self.model, args) for js in records]
+    return [convert_examples_to_features(js, tokenizer, args) for js in records]
+
+
+def iter_source_ids(records, tokenizer, args, cache=None, batch_size=4096):
+    """
+    按批分词，逐条产生 (去掉填充的 source_ids, label)。
+    传入 cache 时先按内容哈希查询 token id 缓存，只对未缓存的代码（去重后）分词并写回缓存。
+
+    参数:
+        records (iterable): 含 code、label 的dict。
+        tokenizer: 分词器。
+        args: 命令行参数（使用 block_size、tokenize_workers、ast_slice）。
+        cache (TokenCache): 与 tokenizer、block_size 和预处理方式对应的缓存，None 表示不使用缓存。
+        batch_size (int): 每批的记录数。
+    """
+    num_workers = getattr(args, 'tokenize_workers', 0)
+    pool = None
+    if getattr(tokenizer, 'is_fast', False) and num_workers > 0:
+        # 进程池在所有批次间复用
+        pool = _open_featurize_pool(tokenizer, num_workers)
+    num_cached = num_tokenized = 0
+    try:
+        for batch in _iter_batches(records, batch_size):
+            if cache is None:
+                for js, feature in zip(batch, _featurize(batch, tokenizer, args, pool=pool)):
+                    yield feature.input_ids[:len(feature.input_tokens)], js['label']
+                continue
+
+            hashes = [record_hash(js) for js in batch]
+            known = cache.get_many(hashes)
+            num_cached += len(known)
+            missing = {}
+            for js, code_hash in zip(batch, hashes):
+                if code_hash not in known:
+                    missing.setdefault(code_hash, js)
+            for code_hash, feature in zip(missing, _featurize(list(missing.values()), tokenizer, args, pool=pool)):
+                known[code_hash] = feature.input_ids[:len(feature.input_tokens)]
+            cache.put_many((code_hash, known[code_hash]) for code_hash in missing)
+            num_tokenized += len(missing)
+            for js, code_hash in zip(batch, hashes):
+                yield known[code_hash], js['label']
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if cache is not None:
+        logger.info("Token cache: %d snippets cached, %d tokenized", num_cached, num_tokenized)
+
+
+def _to_shared_tensor(array):
+    """
+    将内存中构建的 numpy 数组复制到共享内存中的 CPU 张量。
+    """
+    tensor = torch.from_numpy(np.empty(array.shape, dtype=array.dtype)).share_memory_()
+    tensor.numpy()[...] = array
+    return tensor
 
 
 class FewShotTextDataset(Dataset):
     def __init__(self, tokenizer, args, file_path=None):
         """
-        FewShotTextDataset 初始化，加载数据并计算嵌入。
+        FewShotTextDataset 初始化，加载数据并分词。
+        所有样本的 token id 保存在一个连续的 int32 矩阵 input_ids（形状为 (样本数, block_size)）中，
+        标签保存在 int64 数组 example_labels 中，不再为每个样本保存 token 字符串和 id 列表。
+        设置了 args.token_cache_dir 时，同一段代码在所有数据集之间只分词一次。
+        未设置 args.no_dataset_cache 时，构建好的数组缓存在数据文件旁的 dataset_cache 目录中，
+        数据内容、分词器、block_size 和预处理方式均未变化时直接以 mmap 方式加载。
+        设置了 args.ast_slice 时，分词前只保留与量子计算相关的语句（见 relevance_slice）。
+        args.max_chunks 大于 1 时每个文件保留最多 max_chunks 块、每块 block_size 个 token（见 layout_chunks），
+        input_ids 的宽度为 max_chunks * block_size，由 HierarchicalBackbone 分块编码。
         """
-        self.examples = []
-        self.labels = set()
-
-
-        # 处理数据文件中的每一行
-        with open(file_path) as f:
-            for line in f:
-                js = json.loads(line.strip())
-                # feature = convert_examples_to_features(js, tokenizer, self.model, args)
-                feature = convert_examples_to_features(js, tokenizer, args)
-                self.examples.append(feature)
-                self.labels.add(js['label'])  # 收集标签
+        arrays = None
+        cache_dir = None
+        if not getattr(args, 'no_dataset_cache', False):
+            cache_dir = dataset_cache_dir(file_path)
+            variant = feature_variant(args)
+            max_chunks = getattr(args, 'max_chunks', 1)
+            if max_chunks > 1:
+                variant += f":chunks{max_chunks}"
+            fingerprint = dataset_fingerprint(file_path, tokenizer, args.block_size, variant=variant)
+            arrays = load_dataset_cache(cache_dir, fingerprint)
+            if arrays is not None:
+                logger.info("Loaded dataset cache %s", cache_dir)
+        # spawn 启动的 DataLoader worker 反序列化数据集时不复制整个 id 矩阵：
+        # 从缓存加载的数组保持 mmap，worker 按路径重新映射同一个文件；
+        # 内存中构建的数组放入共享内存，worker 只接收共享内存句柄
+        self._mapped_cache = None
+        self._shared = None
+        if arrays is not None:
+            self._mapped_cache = (cache_dir, fingerprint)
+        else:
+            arrays = self._build_arrays(tokenizer, args, file_path)
+            if cache_dir is not None:
+                save_dataset_cache(cache_dir, fingerprint, arrays)
+            self._shared = {name: _to_shared_tensor(array) for name, array in arrays.items()}
+            # numpy 视图与共享内存张量共用同一块内存
+            arrays = {name: tensor.numpy() for name, tensor in self._shared.items()}
+        self._attach_arrays(arrays)
+        self.labels = set(self.example_labels.tolist())  # 收集标签
 
         # 打印一些样例
         if 'train' in file_path:
-            for idx, example in enumerate(self.examples[:3]):
+            for i in range(min(3, len(self))):
+                source_ids = self.input_ids[i, :self.lengths[i]].tolist()
                 logger.info("*** Example ***")
-                logger.info("label: {}".format(example.label))
-                logger.info("input_tokens: {}".format([x.replace('\u0120', '_') for x in example.input_tokens]))
-                logger.info("input_ids: {}".format(' '.join(map(str, example.input_ids))))
-                #
-                # # 打印嵌入的前5个向量，每个向量的前10个值
-                # embedding_preview = example.input_embeddings[:5, :10].cpu()  # 转为 CPU 便于打印
-                # logger.info("embedding preview (first 5 embeddings, first 10 dimensions):\n{}".format(embedding_preview))
+                logger.info("label: {}".format(self.example_labels[i]))
+                logger.info("input_tokens: {}".format(
+                    [x.replace('\u0120', '_') for x in tokenizer.convert_ids_to_tokens(source_ids)]))
+                logger.info("input_ids: {}".format(' '.join(map(str, self.input_ids[i]))))
+
+    def _attach_arrays(self, arrays):
+        self.input_ids = arrays['input_ids']
+        self.lengths = arrays['lengths']
+        self.example_labels = arrays['labels']
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('input_ids', 'lengths', 'example_labels'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._mapped_cache is None:
+            arrays = {name: tensor.numpy() for name, tensor in self._shared.items()}
+        else:
+            # 按指纹重新映射缓存文件；缓存在此期间被替换时不能悄悄使用不同的数据
+            cache_dir, fingerprint = self._mapped_cache
+            arrays = load_dataset_cache(cache_dir, fingerprint)
+            if arrays is None:
+                raise RuntimeError(f"Dataset cache {cache_dir} changed while the dataset was in use.")
+        self._attach_arrays(arrays)
+
+    @staticmethod
+    def _build_arrays(tokenizer, args, file_path):
+        # 处理数据文件（或分片目录、列式语料库）中的每一行
+        rows = []
+        labels = []
+        max_chunks = getattr(args, 'max_chunks', 1)
+        feature_args = args
+        if max_chunks > 1:
+            # 分块模式按整个文件的 token 预算分词，token 缓存也按该长度区分
+            feature_args = copy.copy(args)
+            feature_args.block_size = chunk_token_budget(args.block_size, max_chunks)
+        token_cache_dir = getattr(args, 'token_cache_dir', '')
+        cache = TokenCache(token_cache_dir, tokenizer, feature_args.block_size,
+                           variant=feature_variant(args)) if token_cache_dir else None
+        try:
+            for source_ids, label in iter_source_ids(iter_records(file_path), tokenizer, feature_args, cache=cache):
+                rows.append(np.asarray(source_ids, dtype=np.int32))
+                labels.append(label)
+        finally:
+            if cache is not None:
+                cache.close()
+
+        lengths = np.array([len(row) for row in rows], dtype=np.int32)
+        if max_chunks > 1:
+            input_ids = np.empty((len(rows), max_chunks * args.block_size), dtype=np.int32)
+            for i, row in enumerate(rows):
+                input_ids[i], lengths[i] = layout_chunks(row, args.block_size, max_chunks, tokenizer)
+        else:
+            input_ids = np.full((len(rows), args.block_size), tokenizer.pad_token_id, dtype=np.int32)
+            for i, row in enumerate(rows):
+                input_ids[i, :len(row)] = row
+        return {
+            'input_ids': input_ids,
+            'lengths': lengths,
+            'labels': np.array(labels, dtype=np.int64),
+        }
 
     def __len__(self):
-        return len(self.examples)
+        return len(self.example_labels)
 
     def __getitem__(self, i):
         """
-        返回处理后的 嵌入和标签，供模型直接使用。
+        返回 token id（int32 矩阵中一行的零拷贝视图）和标签，供模型直接使用。
         """
-        # return self.examples[i].input_embeddings, self.examples[i].label
-        return torch.tensor(self.examples[i].input_ids, dtype=torch.long),self.examples[i].label
+        return torch.from_numpy(self.input_ids[i]), int(self.example_labels[i])
 
     def get_labels(self):
         """
@@ -0,0 +1,85 @@
+import logging
+
+from transformers import LongformerConfig, LongformerModel, RobertaModel
+
+logger = logging.getLogger(__name__)
+
+
+def extend_position_embeddings(weight, max_position_embeddings, padding_idx):
+    """
+    把 RoBERTa 学到的位置嵌入平铺到更长的长度（Longformer 的做法）。
+    前 padding_idx + 1 个位置是填充/保留位置，原样保留；其余按原有的位置嵌入循环复制。
+
+    参数:
+        weight (Tensor): 原位置嵌入，形状为 (原长度, hidden_size)。
+        max_position_embeddings (int): 新的位置嵌入个数。
+        padding_idx (int): 填充 token 的 id（RoBERTa 的位置从 padding_idx + 1 开始）。
+
+    返回:
+        Tensor: 形状为 (max_position_embeddings, hidden_size) 的位置嵌入。
+    """
+    offset = padding_idx + 1
+    extended = weight.new_empty(max_position_embeddings, weight.shape[1])
+    extended[:offset] = weight[:offset]
+    learned = weight[offset:]
+    for start in range(offset, max_position_embeddings, len(learned)):
+        end = min(start + len(learned), max_position_embeddings)
+        extended[start:end] = learned[:end - start]
+    return extended
+
+
+def roberta_to_longformer(roberta, max_length, attention_window):
+    """
+    用 CodeBERT（RobertaModel）的权重初始化滑动窗口注意力的 LongformerModel：
+    两者各层结构相同，局部注意力直接使用原有的 query/key/value，全局注意力（只用于 CLS）从它们复制，
+    位置嵌入平铺到 max_length。注意力的时间和内存随序列长度线性增长。
+
+    参数:
+        roberta (RobertaModel): 预训练的 CodeBERT。
+        max_length (int): 最大输入长度（即 block_size）。
+        attention_window (int): 滑动窗口大小（偶数），每个 token 关注前后各 attention_window / 2 个 token。
+
+    返回:
+        LongformerModel: 转换后的模型。
+    """
+    if attention_window % 2:
+        raise ValueError(f"attention_window must be even, got {attention_window}")
+    config_dict = roberta.config.to_dict()
+    for key in ('architectures', 'model_type', 'transformers_version'):
+        config_dict.pop(key, None)
+    config = LongformerConfig(**config_dict)
+    config.attention_window = [attention_window] * config.num_hidden_layers
+    config.max_position_embeddings = max(config.max_position_embeddings, max_length + config.pad_token_id + 1)
+    model = LongformerModel(config, add_pooling_layer=roberta.pooler is not None)
+
+    state_dict = roberta.state_dict()
+    state_dict['embeddings.position_embeddings.weight'] = extend_position_embeddings(
+        state_dict['embeddings.position_embeddings.weight'], config.max_position_embeddings, config.pad_token_id)
+    for name in list(state_dict):
+        for projection in ('query', 'key', 'value'):
+            suffix = f'.attention.self.{projection}.'
+            if suffix in name:
+                state_dict[name.replace(suffix, f'.attention.self.{projection}_global.')] = state_dict[name]
+    # position_ids 等 buffer 的长度随 max_position_embeddings 变化，使用新模型自己的
+    state_dict = {name: value for name, value in state_dict.items() if 'position_ids' not in name}
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing = [name for name in missing if 'position_ids' not in name]
+    if missing or unexpected:
+        raise ValueError(f"Cannot convert RoBERTa weights to Longformer: missing {missing}, unexpected {unexpected}")
+    return model
+
+
+def load_codebert(args, config):
+    """
+    加载 FEAT 使用的编码器：args.backbone 为 'longformer' 时把 CodeBERT 转换为滑动窗口注意力，
+    否则为原来的稠密注意力 RobertaModel。
+    """
+    roberta = RobertaModel.from_pretrained(args.model_name_or_path, config=config)
+    if args.backbone == 'longformer':
+        logger.info("Sliding-window backbone: attention_window=%d, block_size=%d", args.attention_window, args.block_size)
+        return roberta_to_longformer(roberta, args.block_size, args.attention_window)
+    return roberta
+
+
+def is_longformer(model):
+    return isinstance(model, LongformerModel)
@@ -1,8 +1,10 @@
 from __future__ import absolute_import, division, print_function
 import argparse
+import hashlib
 import logging
 import os
 import random
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 import torch
@@ -11,25 +13,232 @@ from easyfsl.modules import resnet12, MultiHeadAttention
 from torch import nn
 import torch.multiprocessing as mp
 from transformers import (
-    RobertaConfig, RobertaTokenizer, RobertaModel)
+    RobertaConfig, RobertaTokenizer, RobertaTokenizerFast)
 
 from Train_FSL import train
 from Test_FSL import test
 
+from corpus_store import is_corpus_store
+from episode_loader import trim_padding
+from long_backbone import is_longformer, load_codebert
 from data_split import split_data
-from split_train import split_train
+from split_train import split_train, write_index_splits
 logger = logging.getLogger(__name__)
 
+def padding_attention_mask(x, pad_token_id):
+    """
+    由 token id 构造 attention mask：只屏蔽每行末尾连续的填充，
+    代码中恰好出现的 pad id 不会被误屏蔽。
+    """
+    not_pad = (x != pad_token_id).long()
+    # 从右向左的累计最大值：最后一个非填充 token 及其之前的位置为 1
+    return torch.flip(torch.cummax(torch.flip(not_pad, [1]), dim=1).values, [1])
+
+
+def pack_segments(lengths, capacity):
+    """
+    首次适应递减（first-fit decreasing）装箱：把长度为 lengths 的序列装入容量为 capacity 的窗口。
+
+    返回:
+        list: 每个窗口中的序列下标列表。
+    """
+    windows = []
+    free = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for w, space in enumerate(free):
+            if lengths[i] <= space:
+                windows[w].append(i)
+                free[w] -= lengths[i]
+                break
+        else:
+            windows.append([i])
+            free.append(capacity - lengths[i])
+    return windows
+
+
 class CustomBackbone(nn.Module):
-    def __init__(self, original_backbone):
+    def __init__(self, original_backbone, pad_token_id=None, pack_size=None):
+        """
+        参数:
+            original_backbone: CodeBERT（RobertaModel，或 long_backbone 转换得到的 LongformerModel）。
+            pad_token_id (int): 设置时为输入构造 attention mask，填充不参与注意力计算，
+                此时输入可以只填充到 batch 中最长的序列（--dynamic_padding）。
+            pack_size (int): 设置时把 batch 中的序列拼接装入长度为 pack_size 的窗口后再编码（需要 pad_token_id），
+                窗口内为块对角注意力，每段使用自己的位置编号和 CLS，结果与逐条编码相同（--pack_sequences）。
+        """
         super(CustomBackbone, self).__init__()
+        if pack_size is not None and (pad_token_id is None or is_longformer(original_backbone)):
+            raise ValueError("Sequence packing needs pad_token_id and a dense RobertaModel backbone.")
         self.original_backbone = original_backbone
+        self.pad_token_id = pad_token_id
+        self.pack_size = pack_size
+
+    def _packed_forward(self, x):
+        lengths = padding_attention_mask(x, self.pad_token_id).sum(dim=1).tolist()
+        windows = pack_segments(lengths, max(self.pack_size, x.shape[1]))
+        width = max(sum(lengths[i] for i in rows) for rows in windows)
+        input_ids = x.new_full((len(windows), width), self.pad_token_id)
+        # 填充位置的位置编号为 padding_idx，与 RoBERTa 自动生成的位置编号一致
+        position_ids = torch.full((len(windows), width), self.pad_token_id, dtype=torch.long, device=x.device)
+        segment_ids = torch.full((len(windows), width), -1, dtype=torch.long, device=x.device)
+        cls_windows = [0] * len(lengths)
+        cls_offsets = [0] * len(lengths)
+        for w, rows in enumerate(windows):
+            offset = 0
+            for segment, i in enumerate(rows):
+                length = lengths[i]
+                tokens = x[i, :length]
+                input_ids[w, offset:offset + length] = tokens
+                # 与 RoBERTa 相同的位置编号规则：从 padding_idx + 1 开始，代码中的 pad id 不占位置
+                not_pad = (tokens != self.pad_token_id).long()
+                position_ids[w, offset:offset + length] = torch.cumsum(not_pad, dim=0) * not_pad + self.pad_token_id
+                segment_ids[w, offset:offset + length] = segment
+                cls_windows[i] = w
+                cls_offsets[i] = offset
+                offset += length
+        # 块对角注意力：每个 token 只关注同一段中的 token；窗口末尾的填充只关注自身，避免整行被屏蔽
+        attention_mask = (segment_ids[:, :, None] == segment_ids[:, None, :]) & (segment_ids[:, :, None] >= 0)
+        attention_mask |= torch.eye(width, dtype=torch.bool, device=x.device)
+        output = self.original_backbone(input_ids, attention_mask=attention_mask.long(),
+                                        position_ids=position_ids).last_hidden_state
+        return output[cls_windows, cls_offsets]
+
+    def _run_layers(self, hidden_states, attention_mask, layers):
+        roberta = self.original_backbone
+        extended_mask = roberta.get_extended_attention_mask(attention_mask, attention_mask.shape)
+        for layer in layers:
+            hidden_states = layer(hidden_states, attention_mask=extended_mask)[0]
+        return hidden_states
+
+    def bottom_hidden_states(self, x, num_layers):
+        """
+        只运行 embedding 层和底部 num_layers 层（--freeze_layers），返回第 num_layers 层的隐藏状态和 attention mask。
+        需要 pad_token_id：填充被屏蔽，真实 token 的隐藏状态与填充长度无关，可以按样本缓存。
+        """
+        attention_mask = padding_attention_mask(x, self.pad_token_id)
+        hidden_states = self.original_backbone.embeddings(input_ids=x)
+        layers = self.original_backbone.encoder.layer[:num_layers]
+        return self._run_layers(hidden_states, attention_mask, layers), attention_mask
+
+    def top_layers_cls(self, hidden_states, attention_mask, num_layers):
+        """
+        从第 num_layers 层的隐藏状态开始运行其余各层，返回 CLS 的嵌入。
+        """
+        layers = self.original_backbone.encoder.layer[num_layers:]
+        return self._run_layers(hidden_states, attention_mask, layers)[:, 0, :]
 
     def forward(self, x):
+        if self.pack_size is not None:
+            return self._packed_forward(x)
         # 获取 CodeBERT 的输出：last_hidden_state
-        output = self.original_backbone(x).last_hidden_state
+        inputs = {}
+        if self.pad_token_id is not None:
+            inputs['attention_mask'] = padding_attention_mask(x, self.pad_token_id)
+        if is_longformer(self.original_backbone):
+            # 滑动窗口注意力下 CLS 使用全局注意力，以汇总整个序列
+            inputs['global_attention_mask'] = torch.zeros_like(x)
+            inputs['global_attention_mask'][:, 0] = 1
+        output = self.original_backbone(x, **inputs).last_hidden_state
         # 对输出展平，确保每个样本是一个 1 维的特征向量
         return output[:, 0, :]  # 提取 [CLS] token 的嵌入作为句子的表示
+
+
+class HierarchicalBackbone(nn.Module):
+    """
+    分层编码长文件：输入为首尾相接的若干块（见 fsl_text_dataset.layout_chunks），
+    每块单独经过 CustomBackbone 得到 CLS 向量，再对文件中非空的块做池化。
+    计算量随文件长度线性增长，而不是随 block_size 平方增长。
+
+    块的嵌入按内容哈希缓存（LRU）：只有在权重不会变化时（eval 模式且 backbone 不参与训练，
+    或未启用梯度）才使用缓存。缓存中的嵌入必须与当前权重一致，凡是改变权重的途径都要清空缓存：
+    在训练模式下对可训练的 backbone 前向（之后会有优化器更新），以及 load_state_dict（如加载最优 checkpoint）。
+    --bf16 autocast 下的嵌入与 float32 不同，autocast 状态也是缓存键的一部分。
+    """
+    def __init__(self, backbone, chunk_size, pad_token_id, pooling='mean', cache_size=20000):
+        """
+        参数:
+            backbone (CustomBackbone): 带 pad_token_id（即使用 attention mask）的块编码器。
+            chunk_size (int): 每块的 token 数（即 block_size）。
+            pad_token_id (int): 填充 token 的 id，全为填充的块不参与编码和池化。
+            pooling (str): 'mean' 或 'max'。
+            cache_size (int): 缓存的块嵌入个数上限，0 表示不缓存。
+        """
+        super(HierarchicalBackbone, self).__init__()
+        self.backbone = backbone
+        self.chunk_size = chunk_size
+        self.pad_token_id = pad_token_id
+        self.pooling = pooling
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # 加载新的权重后缓存的嵌入全部过期
+        self._cache.clear()
+        super(HierarchicalBackbone, self)._load_from_state_dict(*args, **kwargs)
+
+    def _trainable(self):
+        return torch.is_grad_enabled() and any(p.requires_grad for p in self.backbone.parameters())
+
+    def _encode(self, chunks):
+        if self.cache_size <= 0 or self.training or self._trainable():
+            if self.training and self._trainable():
+                # 权重即将更新，缓存的嵌入全部过期
+                self._cache.clear()
+            return self.backbone(trim_padding(chunks, self.pad_token_id))
+
+        precision = b'bf16' if torch.is_autocast_enabled(chunks.device.type) else b''
+        keys = [hashlib.sha1(precision + row.tobytes()).digest() for row in chunks.to(torch.int32).cpu().numpy()]
+        missing = {}
+        for i, key in enumerate(keys):
+            if key not in self._cache:
+                missing.setdefault(key, i)
+        if missing:
+            index = torch.as_tensor(list(missing.values()), device=chunks.device)
+            embeddings = self.backbone(trim_padding(chunks.index_select(0, index), self.pad_token_id))
+            for key, embedding in zip(missing, embeddings.detach()):
+                self._cache[key] = embedding
+        for key in keys:
+            self._cache.move_to_end(key)
+        result = torch.stack([self._cache[key] for key in keys])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def forward(self, x):
+        batch_size, width = x.shape
+        num_chunks = -(-width // self.chunk_size)
+        if width < num_chunks * self.chunk_size:
+            # 动态填充裁剪后的宽度不一定是块长的整数倍，补齐最后一块
+            x = nn.functional.pad(x, (0, num_chunks * self.chunk_size - width), value=self.pad_token_id)
+        chunks = x.reshape(batch_size * num_chunks, self.chunk_size)
+        non_empty = (chunks != self.pad_token_id).any(dim=1)
+        encoded = self._encode(chunks[non_empty])
+        embeddings = encoded.new_zeros(batch_size * num_chunks, encoded.shape[1])
+        embeddings[non_empty] = encoded
+        embeddings = embeddings.reshape(batch_size, num_chunks, -1)
+        non_empty = non_empty.reshape(batch_size, num_chunks, 1)
+        if self.pooling == 'max':
+            return embeddings.masked_fill(~non_empty, float('-inf')).max(dim=1).values
+        return embeddings.sum(dim=1) / non_empty.sum(dim=1).clamp(min=1)
+
+
+def build_backbone(args, codebert_backbone):
+    """
+    按命令行参数构建 FEAT 使用的 backbone：args.max_chunks 大于 1 时为分层编码，否则为 CustomBackbone。
+    """
+    pack_size = args.block_size if args.pack_sequences else None
+    if args.freeze_layers > 0 and (args.max_chunks > 1 or args.backbone != 'dense' or args.freeze_backbone):
+        raise ValueError("--freeze_layers needs the dense backbone without --max_chunks or --freeze_backbone.")
+    if args.max_chunks > 1:
+        # 各文件末尾不满的块也可以装入同一个窗口
+        chunk_backbone = CustomBackbone(codebert_backbone, pad_token_id=args.pad_token_id, pack_size=pack_size)
+        return HierarchicalBackbone(chunk_backbone,
+                                    chunk_size=args.block_size, pad_token_id=args.pad_token_id,
+                                    pooling=args.chunk_pooling, cache_size=args.chunk_cache_size)
+    # 长序列的滑动窗口注意力总是屏蔽填充
+    use_mask = args.dynamic_padding or args.pack_sequences or args.freeze_layers > 0 or args.backbone == 'longformer'
+    return CustomBackbone(codebert_backbone, pad_token_id=args.pad_token_id if use_mask else None,
+                          pack_size=pack_size)
 def set_seed(seed=42):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -46,6 +255,8 @@ def read_args():
                         help="The input training data file (a text file).")
     parser.add_argument("--output_dir", default=None, type=str,
                         help="The output directory where the model predictions and checkpoints will be written.")
+    parser.add_argument("--tot_data", default='../tot_data.jsonl', type=str,
+                        help="The full corpus written by pre_data.py: a jsonl file, a shard directory or a corpus store.")
 
     ## Other parameters
     parser.add_argument("--eval_data_file", default=None, type=str,
@@ -62,10 +273,10 @@ def read_args():
                         help="Whether to run training.")
     parser.add_argument("--do_test", action='store_true',
                         help="Whether to run eval on the dev set.")
-    parser.add_argument("--train_batch_size", default=4, type=int,
-                        help="Batch size per GPU/CPU for training.")
-    parser.add_argument("--eval_batch_size", default=4, type=int,
-                        help="Batch size per GPU/CPU for evaluation.")
+    parser.add_argument("--train_batch_size", default=1, type=int,
+                        help="Number of training episodes encoded in one backbone forward and one optimizer step.")
+    parser.add_argument("--eval_batch_size", default=1, type=int,
+                        help="Number of validation episodes encoded in one backbone forward.")
     parser.add_argument("--learning_rate", default=5e-5, type=float,
                         help="The initial learning rate for Adam.")
     parser.add_argument("--weight_decay", default=5e-4, type=float,
@@ -97,7 +308,63 @@ def read_args():
     parser.add_argument('--n_tasks_per_epoch',  type=int, default=500)
     parser.add_argument('--n_valid_per_epoch',  type=int, default=100)
     parser.add_argument('--n_test_per_epoch',  type=int, default=100)
-    parser.add_argument('--isLocal',  action='store_true')
+    parser.add_argument('--episode_loader', type=str, default='persistent',
+                        choices=['persistent', 'inprocess', 'dataloader'],
+                        help="persistent: one long-lived worker pool per fold serving training and validation "
+                             "episodes; inprocess: gather episodes from the id matrix in the main process; "
+                             "dataloader: a fresh DataLoader per epoch.")
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help="Worker processes preparing episodes (0: prepare them in the main process).")
+    parser.add_argument('--prefetch_depth', type=int, default=8,
+                        help="Episodes prepared ahead of the model by the persistent episode workers.")
+    parser.add_argument('--isLocal',  action='store_true',
+                        help="Deprecated: dataset caches are reused automatically whenever they are fresh.")
+    parser.add_argument('--no_dataset_cache', action='store_true',
+                        help="Always rebuild datasets instead of loading/writing the per-file dataset_cache.")
+    parser.add_argument('--fast_tokenizer', action='store_true',
+                        help="Featurize datasets in batches with the Rust-backed RobertaTokenizerFast.")
+    parser.add_argument('--tokenize_workers', type=int, default=0,
+                        help="Processes used by --fast_tokenizer featurization (0: tokenize in the main process).")
+    parser.add_argument('--token_cache_dir', type=str, default='../token_cache',
+                        help="Content-addressed token id cache shared by all datasets (empty string disables it).")
+    parser.add_argument('--ast_slice', action='store_true',
+                        help="Keep only quantum-relevant statements and their dependencies before tokenization.")
+    parser.add_argument('--backbone', type=str, default='dense', choices=['dense', 'longformer'],
+                        help="dense: CodeBERT as is (block_size <= 512); longformer: CodeBERT converted to "
+                             "sliding-window attention with a global CLS token, for block_size in the thousands.")
+    parser.add_argument('--attention_window', type=int, default=256,
+                        help="Sliding attention window (even) of the longformer backbone.")
+    parser.add_argument('--max_chunks', type=int, default=1,
+                        help="Encode up to this many block_size chunks per file and pool their CLS vectors "
+                             "(1: truncate files to block_size).")
+    parser.add_argument('--chunk_pooling', type=str, default='mean', choices=['mean', 'max'],
+                        help="How chunk CLS vectors are pooled into the file embedding.")
+    parser.add_argument('--chunk_cache_size', type=int, default=20000,
+                        help="Chunk embeddings cached by content hash while the backbone is not being trained.")
+    parser.add_argument('--pack_sequences', action='store_true',
+                        help="Pack the snippets of each backbone batch into shared block_size windows with "
+                             "block-diagonal attention (dense backbone only).")
+    parser.add_argument('--freeze_backbone', action='store_true',
+                        help="Keep CodeBERT frozen: encode every snippet once (cached on disk) and train only "
+                             "the FEAT attention module on the cached CLS embeddings.")
+    parser.add_argument('--embedding_cache_dir', type=str, default='../embedding_cache',
+                        help="Content-addressed CLS embedding cache used by --freeze_backbone.")
+    parser.add_argument('--freeze_layers', type=int, default=0,
+                        help="Freeze the embeddings and the bottom K encoder layers; their layer-K hidden states "
+                             "are cached once (float16, memory-mapped) and episodes only run the top layers.")
+    parser.add_argument('--hidden_cache_dir', type=str, default='../hidden_cache',
+                        help="Content-addressed cache of layer-K hidden states used by --freeze_layers.")
+    parser.add_argument('--embedding_batch_size', type=int, default=64,
+                        help="Batch size used to encode snippets for the embedding and hidden-state caches.")
+    parser.add_argument('--fused_episodes', action='store_true',
+                        help="Encode the support and query sets of an episode in a single backbone pass.")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Run the backbone and the FEAT head under bfloat16 autocast "
+                             "(float32 master weights and loss).")
+    parser.add_argument('--dynamic_padding', action='store_true',
+                        help="Pad each episode only to its longest snippet and mask padding in the backbone.")
+    parser.add_argument('--length_buckets', type=int, default=0,
+                        help="Sample each episode from one of K per-class length buckets (0: uniform sampling).")
 
 
     return parser
@@ -117,17 +384,28 @@ def main():
                         datefmt='%m/%d/%Y %H:%M:%S',
                         level=logging.INFO)
     logger.warning("device: %s, n_gpu: %s", device, args.n_gpu)
+    if args.bf16 and device.type == 'cpu' and not getattr(torch.cpu, '_is_avx512_bf16_supported', lambda: False)():
+        logger.warning("--bf16: this CPU has no native bfloat16 support; autocast will be emulated and slower.")
+    if args.isLocal:
+        logger.warning("--isLocal is deprecated: fresh dataset caches are loaded automatically.")
 
     # Set seed
     set_seed(args.seed)
 
     config = RobertaConfig.from_pretrained(args.model_name_or_path, local_files_only=True)
     config.num_labels=2
-    tokenizer = RobertaTokenizer.from_pretrained(args.tokenizer_name, local_files_only=True)
+    tokenizer_class = RobertaTokenizerFast if args.fast_tokenizer else RobertaTokenizer
+    tokenizer = tokenizer_class.from_pretrained(args.tokenizer_name, local_files_only=True)
+    args.pad_token_id = tokenizer.pad_token_id
 
 
     logger.info("Training/evaluation parameters %s", args)
-    tot_dataset = '../tot_data.jsonl'
+    tot_dataset = args.tot_data
+    # 列式语料库使用行号划分：所有 time 的划分一次性生成，训练/测试时按行号惰性读取
+    use_index_splits = is_corpus_store(tot_dataset)
+    split_ext = '.ids.npz' if use_index_splits else '.jsonl'
+    if args.do_train and use_index_splits:
+        write_index_splits(tot_dataset, '..', args.num_times, num_folds=args.num_folds, test_ratio=0.2, seed=args.seed)
     accuracys_on_model = []
     precisions_on_model = []
     recalls_on_model =[]
@@ -137,22 +415,22 @@ def main():
         if args.do_train :
             logger.info(f"Starting training time {time + 1}/{args.num_times}")
             prefix_time = f'../data{time}'
-            split_train(input_jsonl=tot_dataset,output_dir=prefix_time,time = time,test_ratio=0.2)
-            train_data_file = os.path.join(prefix_time, f'{time}data.jsonl')# 修改为实际输入文件路径
+            if not use_index_splits:
+                split_train(input_jsonl=tot_dataset,output_dir=prefix_time,time = time,test_ratio=0.2)
+            train_data_file = os.path.join(prefix_time, f'{time}data{split_ext}')# 修改为实际输入文件路径
 
             split_output_dir = os.path.join(prefix_time,f'fold')
             if not os.path.exists(os.path.join(prefix_time,f'fold')):
                 os.makedirs(os.path.join(prefix_time,f'fold'))
-            if not os.path.exists(os.path.join(prefix_time,f'pkl')):
-                os.makedirs(os.path.join(prefix_time,f'pkl'))
-            split_data(train_data_file, split_output_dir,time=time,num_folds=args.num_folds)  # Assuming this function supports k-fold splitting
+            if not use_index_splits:
+                split_data(train_data_file, split_output_dir,time=time,num_folds=args.num_folds)  # Assuming this function supports k-fold splitting
 
             for fold in range(args.num_folds):
                 logger.info(f"Starting training fold {fold + 1}/{args.num_folds}")
 
                 attention_module = MultiHeadAttention(8, config.hidden_size, 640, 640).to(args.device)
-                codebert_backbone = RobertaModel.from_pretrained(args.model_name_or_path, config=config)
-                custom_backbone = CustomBackbone(codebert_backbone)
+                codebert_backbone = load_codebert(args, config)
+                custom_backbone = build_backbone(args, codebert_backbone)
                 model = FEAT(
                     backbone=custom_backbone,
                     attention_module=attention_module
@@ -160,8 +438,8 @@ def main():
 
 
                 # Set training and evaluation files
-                train_data_file = os.path.join(split_output_dir, f'{time}train_fold{fold}.jsonl')
-                eval_data_file = os.path.join(split_output_dir, f'{time}valid_fold{fold}.jsonl')
+                train_data_file = os.path.join(split_output_dir, f'{time}train_fold{fold}{split_ext}')
+                eval_data_file = os.path.join(split_output_dir, f'{time}valid_fold{fold}{split_ext}')
 
 
                 args.train_data_file = train_data_file
@@ -173,8 +451,8 @@ def main():
         if args.do_test:
             logger.info(f"Starting Testing time {time + 1}/{args.num_times}")
             prefix_time = f'../data{time}'
-            args.train_data_file = os.path.join(prefix_time,f'{time}data.jsonl')
-            args.test_data_file = os.path.join(prefix_time,f'{time}test.jsonl')
+            args.train_data_file = os.path.join(prefix_time,f'{time}data{split_ext}')
+            args.test_data_file = os.path.join(prefix_time,f'{time}test{split_ext}')
 
             if not os.path.exists(os.path.join(prefix_time,f'csv')):
                 os.makedirs(os.path.join(prefix_time,f'csv'))
@@ -188,8 +466,8 @@ def main():
                 logger.info(f"Starting Testing fold {fold + 1}/{args.num_folds}")
 
                 attention_module = MultiHeadAttention(8, config.hidden_size, 640, 640).to(args.device)
-                codebert_backbone = RobertaModel.from_pretrained(args.model_name_or_path, config=config)
-                custom_backbone = CustomBackbone(codebert_backbone)
+                codebert_backbone = load_codebert(args, config)
+                custom_backbone = build_backbone(args, codebert_backbone)
 
                 model = FEAT(
                     backbone=custom_backbone,
@@ -0,0 +1,102 @@
+import zlib
+
+import numpy as np
+
+# 取小于 2^32 的最大素数作为哈希模数，a < 2^31 保证 a * h + b 不会溢出 uint64
+_PRIME = np.uint64(4294967291)
+_HASH_BLOCK = 8192
+_SHINGLE_BASE = np.uint64(1000003)
+
+
+def _permutations(num_perm, seed):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 31, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+    return a[:, None], b[:, None]
+
+
+def minhash_signature(code, num_perm=64, shingle_size=5, seed=1):
+    """
+    计算代码的 MinHash 签名。代码按空白切分为词，以连续 shingle_size 个词为一个 shingle，
+    签名的逐位相等比例近似两份代码 shingle 集合的 Jaccard 相似度。
+
+    参数:
+        code (str): 清洗后的代码。
+        num_perm (int): 哈希函数个数（签名长度）。
+        shingle_size (int): 每个 shingle 包含的词数。
+        seed (int): 哈希函数的随机种子，同一索引中的签名必须使用相同的种子。
+
+    返回:
+        np.ndarray: 形状为 (num_perm,) 的 uint32 签名。
+    """
+    tokens = code.split()
+    token_hashes = {}
+    ids = np.fromiter((token_hashes.setdefault(token, zlib.crc32(token.encode('utf-8'))) for token in tokens),
+                      dtype=np.uint64, count=len(tokens))
+    if len(ids) < shingle_size:
+        ids = np.concatenate([ids, np.zeros(shingle_size - len(ids), dtype=np.uint64)])
+    # 以多项式滚动组合连续 shingle_size 个词的哈希（uint64 溢出即取模 2^64），再去重
+    num_shingles = len(ids) - shingle_size + 1
+    combined = np.zeros(num_shingles, dtype=np.uint64)
+    for offset in range(shingle_size):
+        combined = combined * _SHINGLE_BASE + ids[offset:offset + num_shingles]
+    hashes = np.unique(combined) % _PRIME
+
+    a, b = _permutations(num_perm, seed)
+    signature = np.full(num_perm, _PRIME, dtype=np.uint64)
+    # 分块计算，避免大文件上 (num_perm, shingle数) 的矩阵占用过多内存
+    for start in range(0, len(hashes), _HASH_BLOCK):
+        block = hashes[None, start:start + _HASH_BLOCK]
+        signature = np.minimum(signature, ((a * block + b) % _PRIME).min(axis=1))
+    return signature.astype(np.uint32)
+
+
+class NearDuplicateIndex(object):
+    """
+    基于 MinHash + LSH 分桶的近似重复索引，按插入顺序做"首个代表"聚类：
+    新文件与某个已有组的代表的估计 Jaccard 相似度不低于 threshold 时加入该组，否则自成一组。
+    分桶的键包含标签，只有相同标签的文件才会成为同一组（同一文件的有缺陷/已修复版本互为近似重复，不能合并）。
+    只有各组的代表写入分桶，桶的大小与不同组的数量相关而非文件总数，
+    每次插入只需比较同桶候选，整体复杂度远低于两两比较。
+    """
+    def __init__(self, num_perm=64, bands=8, threshold=0.8):
+        """
+        参数:
+            num_perm (int): 签名长度，须能被 bands 整除。
+            bands (int): LSH 分带数；候选阈值约为 (1 / bands) ** (bands / num_perm)。
+            threshold (float): 判定为近似重复的估计 Jaccard 相似度下限。
+        """
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands}).")
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)]
+        self.keys = []
+        self.signatures = np.empty((16, num_perm), dtype=np.uint32)
+
+    def _band_keys(self, signature, label):
+        return [(label, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def add(self, key, signature, label=None):
+        """
+        插入一个文件并返回其所属组的代表 key（自成一组时为其自身的 key）。
+        只与标签相同的已有组比较。
+        """
+        band_keys = self._band_keys(signature, label)
+        candidates = set()
+        for bucket, band_key in zip(self.buckets, band_keys):
+            candidates.update(bucket.get(band_key, ()))
+        # 按插入顺序比较，结果与并行处理的顺序无关
+        for candidate in sorted(candidates):
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                return self.keys[candidate]
+
+        representative = len(self.keys)
+        if representative == len(self.signatures):
+            self.signatures = np.resize(self.signatures, (2 * len(self.signatures), self.signatures.shape[1]))
+        self.signatures[representative] = signature
+        self.keys.append(key)
+        for bucket, band_key in zip(self.buckets, band_keys):
+            bucket.setdefault(band_key, []).append(representative)
+        return key
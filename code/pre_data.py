@@ -1,10 +1,93 @@
+import argparse
+import functools
+import hashlib
+import multiprocessing
 import os
+import re
+import numpy as np
 import pandas as pd
 
 import json
+
+from corpus_io import JsonlIndex, iter_jsonl, open_corpus_writer
+from corpus_store import build_corpus_store
+from near_dup import NearDuplicateIndex, minhash_signature
+
+# 清洗逻辑或清单格式变化时递增，使旧的增量清单整体失效
+INGEST_VERSION = 3
+# 工作进程返回该值表示文件未变化，可直接复用旧输出中的记录
+_REUSE = 'reuse'
+
+
+# 单遍扫描用的词法模式：与 tokenize 对字符串和注释的划分一致。
+# 以字符集 [#'"] 开头，正则引擎可以直接跳到候选位置；各分支互斥，不会出现灾难性回溯。
+# 无法匹配完整三引号字符串时落入 unterminated 分支，表示代码无法被 tokenize。
+_CODE_SCANNER = re.compile(r"""
+    [#'"]
+    (?:
+        (?<=\#) (?P<comment> [^\n]* )
+      | (?<=') (?P<triple_single> '' [^'\\]* (?: (?:\\.|'(?!'')) [^'\\]* )* ''' )
+      | (?<=") (?P<triple_double> "" [^"\\]* (?: (?:\\.|"(?!"")) [^"\\]* )* \"\"\" )
+      | (?<=') (?!'') [^'\\\n]* (?: \\. [^'\\\n]* )* '
+      | (?<=") (?!"") [^"\\\n]* (?: \\. [^"\\\n]* )* "
+      | (?P<unterminated> '' | "" )
+    )
+""", re.VERBOSE | re.DOTALL)
+
+
+def _strip_comments_regex(code):
+    """
+    基于正则的注释移除（旧实现），仅在代码无法被词法扫描时作为回退使用。
+    注意 '#.*' 会截断包含 # 的字符串，赋值给变量的三引号字符串也会被删除。
+    """
+    # 移除行注释（#开头的注释）
+    code = re.sub(r'#.*', '', code)
+
+    # 移除块注释（'''或"""包裹的注释）
+    code = re.sub(r'\'\'\'(.*?)\'\'\'', '', code, flags=re.DOTALL)
+    code = re.sub(r'\"\"\"(.*?)\"\"\"', '', code, flags=re.DOTALL)
+    return code
+
+
+def _strip_comments_scan(code):
+    """
+    单遍、线性时间的注释移除：按 tokenize 的规则扫描字符串和注释，
+    删除注释以及单独占据一行的三引号字符串（文档字符串/块注释），其余代码原样保留。
+    因此字符串中的 # 不会被误删，赋值给变量的三引号字符串也会保留。
+
+    返回:
+        str: 移除了注释的代码；存在未闭合的三引号字符串（无法被 tokenize）时返回 None。
+    """
+    pieces = []
+    position = 0
+    for match in _CODE_SCANNER.finditer(code):
+        kind = match.lastgroup
+        if kind is None:
+            continue  # 单行字符串，原样保留
+        if kind == 'unterminated':
+            return None
+        start, end = match.span()
+        if kind != 'comment':
+            # 只有前面只有缩进、后面只有空白或注释的三引号字符串才视为块注释
+            while start > 0 and code[start - 1] in 'rRuUbBfF':
+                start -= 1
+            line_start = code.rfind('\n', 0, start) + 1
+            line_end = code.find('\n', end)
+            if line_end == -1:
+                line_end = len(code)
+            rest = code[end:line_end].lstrip()
+            if code[line_start:start].strip() or (rest and not rest.startswith('#')):
+                continue
+        pieces.append(code[position:start])
+        position = end
+    pieces.append(code[position:])
+    return ''.join(pieces)
+
+
 def remove_comments_from_code(code):
     """
     移除Python代码中的注释内容，包括行注释和块注释。
+    优先使用单遍的词法扫描实现，代码无法被扫描时回退到正则实现。
 
     参数:
         code (str): Python代码内容。
@@ -12,16 +95,11 @@ def remove_comments_from_code(code):
     返回:
         str: 移除了注释的代码。
     """
-    import re
-    # 移除行注释（#开头的注释）
-    code = re.sub(r'#.*', '', code)
-
-    # 移除块注释（'''或"""包裹的注释）
-    code = re.sub(r'\'\'\'(.*?)\'\'\'', '', code, flags=re.DOTALL)
-    code = re.sub(r'\"\"\"(.*?)\"\"\"', '', code, flags=re.DOTALL)
+    stripped = _strip_comments_scan(code)
+    code = stripped if stripped is not None else _strip_comments_regex(code)
 
-    # 移除多余的空行，将多个换行替换为一个
-    code = re.sub(r'\n\s*\n', '\n', code)
+    # 移除空行和行尾空白
+    code = '\n'.join(line.rstrip() for line in code.split('\n') if line.strip())
     code = code.strip()
     # 去除首尾空白字符后，检查代码内容是否为空
     if code == '':
@@ -128,6 +206,290 @@ def read_python_files(root_dir=None, output_jsonl=None):
 
 
 
+def _iter_python_files(root_dir):
+    """
+    按 os.walk 的顺序遍历root_dir下的子文件夹，并按子文件夹分配数值标签（与 read_python_files 一致）。
+
+    返回:
+        生成器，依次产出 (file_path, class_name, label)。
+    """
+    class_name_to_label = {}
+    for foldername, subfolders, filenames in os.walk(root_dir):
+        if foldername == root_dir:
+            continue
+        class_name = os.path.basename(foldername)
+        if class_name not in class_name_to_label:
+            class_name_to_label[class_name] = len(class_name_to_label)
+        label = class_name_to_label[class_name]
+        for filename in filenames:
+            if filename.endswith(".py"):
+                yield os.path.join(foldername, filename), class_name, label
+
+
+def _clean_python_file(task, with_signature=False):
+    """
+    进程池中的工作函数：读取单个.py文件并移除注释。
+    若提供了上一次的文件信息且 mtime/大小 或内容哈希未变，则不再清洗，直接返回 _REUSE。
+
+    参数:
+        task (tuple): (file_path, rel_path, label, previous)，previous 为增量清单中的旧条目或 None。
+        with_signature (bool): 是否同时计算 MinHash 签名（放在记录的 minhash 字段中，写出前移除）。
+
+    返回:
+        tuple: (file_path, rel_path, file_info, record)。record 为可直接写入jsonl的记录、
+            _REUSE，或 None（文件为空或读取失败）；读取失败时 file_info 为 None。
+    """
+    file_path, rel_path, label, previous = task
+    try:
+        stat = os.stat(file_path)
+        if previous is not None and (previous['mtime_ns'], previous['size']) == (stat.st_mtime_ns, stat.st_size):
+            return file_path, rel_path, previous, _REUSE
+        with open(file_path, 'rb') as f:
+            raw_content = f.read()
+        # 与文本模式读取一致，统一换行符
+        file_content = raw_content.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+    except Exception as e:
+        print(f"Error reading file {file_path}: {e}")
+        return file_path, rel_path, None, None
+
+    file_info = {
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': hashlib.sha1(raw_content).hexdigest(),
+        'label': label,
+        'empty': False,
+    }
+    if previous is not None and previous['sha1'] == file_info['sha1']:
+        file_info['empty'] = previous['empty']
+        return file_path, rel_path, file_info, _REUSE
+
+    file_content = remove_comments_from_code(file_content)
+    if file_content is None:
+        print(f"Skipping empty file: {file_path}")
+        file_info['empty'] = True
+        return file_path, rel_path, file_info, None
+    record = {
+        "code": file_content,
+        "label": label,
+        "path": rel_path,
+        "hash": hashlib.sha1(file_content.encode('utf-8')).hexdigest(),
+    }
+    if with_signature:
+        record['minhash'] = minhash_signature(file_content)
+    return file_path, rel_path, file_info, record
+
+
+def _ingest_manifest_path(output_jsonl):
+    """
+    增量清单保存在输出旁边，例如 ../tot_data.jsonl.ingest.json。
+    """
+    return output_jsonl.rstrip(os.sep) + '.ingest.json'
+
+
+def _signature_cache_path(output_jsonl):
+    """
+    近似去重时缓存的 MinHash 签名，按清洗后代码的哈希索引，例如 ../tot_data.jsonl.minhash.npz。
+    """
+    return output_jsonl.rstrip(os.sep) + '.minhash.npz'
+
+
+def _load_signature_cache(output_jsonl):
+    cache_path = _signature_cache_path(output_jsonl)
+    if not os.path.exists(cache_path):
+        return {}
+    with np.load(cache_path) as data:
+        return {code_hash.decode('ascii'): signature for code_hash, signature in zip(data['hashes'], data['signatures'])}
+
+
+def _load_ingest_manifest(root_dir, output_jsonl, dedup_settings):
+    """
+    读取上一次运行的增量清单；清单缺失、版本、根目录或去重设置不符、输出已不存在时返回空清单。
+    """
+    manifest_path = _ingest_manifest_path(output_jsonl)
+    if not (os.path.exists(manifest_path) and os.path.exists(output_jsonl)):
+        return {}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != INGEST_VERSION or manifest.get('root_dir') != os.path.abspath(root_dir):
+        return {}
+    if manifest.get('dedup') != dedup_settings:
+        return {}
+    return manifest['files']
+
+
+def stream_python_files(root_dir=None, output_jsonl=None, num_workers=None, chunksize=16, shard_size=None,
+                        incremental=False, dedup=None, dedup_threshold=0.8):
+    """
+    并行、流式版本的 read_python_files：在进程池中读取并清洗文件，
+    处理完成的记录按遍历顺序直接写入jsonl，不再经过DataFrame。
+    读取失败的文件会被跳过，而不是写出 code 为 null 的记录。
+    每条记录除 code、label 外还包含相对路径 path 和清洗后代码的 sha1（hash）。
+
+    每次运行都会在输出旁写入增量清单（文件的 mtime、大小、内容哈希，以及记录在输出中的位置）。
+    incremental 为 True 时，未变化的文件按清单中的位置直接从旧输出复制原始字节，不解析旧输出，
+    只有新增或修改的文件会被重新读取和清洗，已删除的文件不再写出。
+
+    dedup 不为空时，用 MinHash + LSH（near_dup.NearDuplicateIndex）在写出前检测近似重复：
+    每条记录增加 group 字段，值为所在组代表文件（标签相同）的 path，split_train / split_data 会把同一组划分到同一侧；
+    dedup='drop' 时只保留每组的代表。签名缓存在输出旁，增量运行时未变化的文件无需重新计算。
+
+    参数:
+        root_dir (str): 根目录路径，默认为当前工作目录下的data文件夹。
+        output_jsonl (str): 输出的jsonl文件路径；分片模式下为分片目录。
+        num_workers (int, 可选): 进程数，默认为CPU核数；为1时在当前进程中顺序处理。
+        chunksize (int): 每次分发给工作进程的文件数。
+        shard_size (int, 可选): 单个分片的最大字节数。提供时输出为分片目录加 manifest.json，
+            内存占用不随语料规模增长，下游通过 corpus_io.iter_jsonl 读取。
+        incremental (bool): 是否基于上一次的增量清单只处理变化的文件。
+        dedup (str, 可选): None、'group' 或 'drop'。
+        dedup_threshold (float): 判定为近似重复的估计 Jaccard 相似度下限。
+
+    返回:
+        int: 写入的记录数。
+    """
+    if root_dir is None:
+        root_dir = os.path.join(os.getcwd(), "data")
+    if not os.path.exists(root_dir):
+        raise FileNotFoundError(f"The directory '{root_dir}' does not exist.")
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    output_dir = os.path.dirname(output_jsonl.rstrip(os.sep))
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    dedup_settings = [dedup, dedup_threshold] if dedup else None
+    previous_files = _load_ingest_manifest(root_dir, output_jsonl, dedup_settings) if incremental else {}
+    previous_output = JsonlIndex(output_jsonl, {rel_path: info['location'] for rel_path, info in previous_files.items()
+                                                 if 'location' in info}) if previous_files else None
+    dedup_index = NearDuplicateIndex(threshold=dedup_threshold) if dedup else None
+    previous_signatures = _load_signature_cache(output_jsonl) if dedup and previous_files else {}
+    signatures = {}
+
+    def make_tasks():
+        for file_path, class_name, label in _iter_python_files(root_dir):
+            rel_path = os.path.relpath(file_path, root_dir).replace(os.sep, '/')
+            previous = previous_files.get(rel_path)
+            # 标签变化（例如新增了类别文件夹）时不能复用旧记录
+            if previous is not None and previous['label'] != label:
+                previous = None
+            yield file_path, rel_path, label, previous
+
+    tasks = make_tasks()
+    clean = functools.partial(_clean_python_file, with_signature=dedup_index is not None)
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    # imap 保持输入顺序，输出与单进程版本逐行一致
+    results = pool.imap(clean, tasks, chunksize=chunksize) if pool else map(clean, tasks)
+
+    files = {}
+    num_reused = 0
+    # 写入器先写临时文件，成功后再替换，避免中断时留下半个 tot_data
+    writer = open_corpus_writer(output_jsonl, shard_size=shard_size)
+    try:
+        for file_path, rel_path, file_info, record in results:
+            if file_info is None:
+                continue
+            line = None
+            if record == _REUSE:
+                if file_info['empty']:
+                    files[rel_path] = file_info
+                    num_reused += 1
+                    continue
+                if rel_path in previous_output:
+                    line = previous_output.get_line(rel_path)
+                    num_reused += 1
+                else:
+                    # 旧输出中找不到该记录（例如上次作为重复被丢弃），重新清洗
+                    file_path, rel_path, file_info, record = clean((file_path, rel_path, file_info['label'], None))
+                    if file_info is None:
+                        continue
+            # 位置只记录本次实际写出的行
+            file_info = {key: value for key, value in file_info.items() if key != 'location'}
+            files[rel_path] = file_info
+
+            if dedup_index is None:
+                if line is not None:
+                    file_info['location'] = writer.write_line(line)
+                elif record is not None:
+                    file_info['location'] = writer.write(record)
+                continue
+
+            if line is not None:
+                record = json.loads(line)
+            if record is None:
+                continue
+            signature = record.pop('minhash', None)
+            if signature is None:
+                signature = previous_signatures.get(record['hash'])
+            if signature is None:
+                signature = minhash_signature(record['code'])
+            signatures[record['hash']] = signature
+            record['group'] = dedup_index.add(rel_path, signature, label=record['label'])
+            if dedup == 'drop' and record['group'] != rel_path:
+                continue
+            file_info['location'] = writer.write(record)
+        writer.close()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if previous_output is not None:
+            previous_output.close()
+
+    if dedup_index is not None:
+        cache_path = _signature_cache_path(output_jsonl)
+        with open(cache_path + '.tmp', 'wb') as f:
+            np.savez(f, hashes=np.array(list(signatures), dtype='S40'),
+                     signatures=np.array(list(signatures.values()), dtype=np.uint32).reshape(len(signatures), -1))
+        os.replace(cache_path + '.tmp', cache_path)
+        num_groups = len(dedup_index.keys)
+        print(f"Near-duplicate detection: {num_groups} groups, "
+              f"{len(signatures) - num_groups} near-duplicates {'dropped' if dedup == 'drop' else 'grouped'}")
+
+    manifest = {'version': INGEST_VERSION, 'root_dir': os.path.abspath(root_dir), 'dedup': dedup_settings,
+                'files': files}
+    manifest_path = _ingest_manifest_path(output_jsonl)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    if incremental:
+        num_deleted = len(set(previous_files) - set(files))
+        print(f"Incremental ingestion: {num_reused} unchanged, {len(files) - num_reused} new or changed, "
+              f"{num_deleted} deleted")
+    print(f"Data saved to {output_jsonl} ({writer.num_records} records)")
+    return writer.num_records
+
+
+def read_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", default='../source', type=str,
+                        help="Root directory whose sub folders hold the labelled .py files.")
+    parser.add_argument("--output_jsonl", default='../tot_data.jsonl', type=str,
+                        help="Where to write the cleaned corpus.")
+    parser.add_argument("--num_workers", default=None, type=int,
+                        help="Number of ingestion processes (default: all CPUs, 1 disables the pool).")
+    parser.add_argument("--shard_size_mb", default=None, type=float,
+                        help="Write output_jsonl as a directory of shards of at most this many MB plus a manifest.")
+    parser.add_argument("--full_rebuild", action='store_true',
+                        help="Ignore the ingestion manifest and re-read every file.")
+    parser.add_argument("--dedup", default=None, choices=['group', 'drop'],
+                        help="Detect near-duplicate files with MinHash/LSH and group them (kept on one side of every "
+                             "split) or drop all but the first file of each group.")
+    parser.add_argument("--dedup_threshold", default=0.8, type=float,
+                        help="Estimated Jaccard similarity above which two files are near-duplicates.")
+    parser.add_argument("--store_dir", default=None, type=str,
+                        help="Also write the corpus as a memory-mappable columnar store (e.g. ../tot_data.store).")
+    return parser
+
+
 if __name__ == '__main__':
     # load_data()
-    read_python_files(root_dir='../source',output_jsonl='../tot_data.jsonl')
\ No newline at end of file
+    args = read_args().parse_args()
+    shard_size = int(args.shard_size_mb * 2 ** 20) if args.shard_size_mb else None
+    stream_python_files(root_dir=args.root_dir, output_jsonl=args.output_jsonl, num_workers=args.num_workers,
+                        shard_size=shard_size, incremental=not args.full_rebuild, dedup=args.dedup,
+                        dedup_threshold=args.dedup_threshold)
+    if args.store_dir:
+        store = build_corpus_store(iter_jsonl(args.output_jsonl), args.store_dir)
+        print(f"Corpus store saved to {args.store_dir} ({len(store)} records)")
@@ -0,0 +1,231 @@
+import ast
+import re
+
+from ast_operations import Ast_parser
+
+# 切片规则的版本，作为 token 缓存和数据集缓存键的一部分；切片结果变化时加一，使旧缓存失效
+SLICER_VERSION = 2
+
+# 没有对应 import 语句（代码片段常常不完整）时也视为量子相关的名称
+QUANTUM_NAMES = {
+    'qiskit', 'QuantumCircuit', 'QuantumRegister', 'ClassicalRegister', 'AncillaRegister',
+    'execute', 'transpile', 'assemble', 'Aer', 'BasicAer', 'IBMQ', 'AerSimulator', 'QasmSimulator',
+    'Statevector', 'DensityMatrix', 'Operator', 'Pauli', 'SparsePauliOp', 'TwoLocal', 'QFT',
+    'QuantumInstance', 'Sampler', 'Estimator', 'Parameter', 'ParameterVector',
+}
+# 只用于展示结果的调用（绘图、打印），不作为切片的起点
+DISPLAY_NAMES = {'print', 'display', 'draw', 'circuit_drawer', 'plt', 'show', 'savefig', 'matplotlib', 'sns'}
+# 复合语句中属于语句体而不是语句头的字段
+_BODY_FIELDS = {'body', 'orelse', 'finalbody', 'handlers', 'cases'}
+# 没有单独 AST 节点的子句头：else: 和 finally:
+_CLAUSE_KEYWORDS = {'orelse': re.compile(r'\s*else\s*:'), 'finalbody': re.compile(r'\s*finally\s*:')}
+
+
+def _is_compound(node):
+    return isinstance(getattr(node, 'body', None), list) or isinstance(node, ast.Match)
+
+
+def _first_body_lineno(node):
+    # match 语句没有 body，语句体从第一个 case 开始
+    return node.cases[0].pattern.lineno if isinstance(node, ast.Match) else node.body[0].lineno
+
+
+def _header_nodes(node):
+    """
+    语句自身的表达式：简单语句为整条语句，复合语句只取语句头（如 for 的目标和迭代对象、if 的条件）。
+    """
+    if not _is_compound(node):
+        return [node]
+    nodes = []
+    for field, value in ast.iter_fields(node):
+        if field in _BODY_FIELDS:
+            continue
+        nodes.extend(item for item in (value if isinstance(value, list) else [value]) if isinstance(item, ast.AST))
+    return nodes
+
+
+def _call_parts(func):
+    """
+    调用对象的名称链，例如 qc.measure(...) 为 ['qc', 'measure']，
+    Aer.get_backend('qasm_simulator').run(...) 为 ['Aer', 'get_backend', 'run']。
+    """
+    parts = []
+    while True:
+        if isinstance(func, ast.Attribute):
+            parts.append(func.attr)
+            func = func.value
+        elif isinstance(func, ast.Call):
+            func = func.func
+        elif isinstance(func, ast.Subscript):
+            func = func.value
+        elif isinstance(func, ast.Name):
+            parts.append(func.id)
+            break
+        else:
+            break
+    return parts[::-1]
+
+
+def _is_display(parts):
+    return any(part in DISPLAY_NAMES or part.startswith('plot_') for part in parts)
+
+
+def _qiskit_module(module):
+    return module is not None and module.split('.')[0] == 'qiskit' and not module.startswith('qiskit.visualization')
+
+
+class _Statement(object):
+    """
+    切片使用的语句信息：读取、写入的名称和其中的调用。
+    """
+    def __init__(self, node, parent, clause=()):
+        self.node = node
+        self.parent = parent
+        # 语句所在子句的子句头（else:、except ...:、finally:、case ...:）的行号
+        self.clause = clause
+        self.loads = set()
+        self.stores = set()
+        self.calls = []
+        for header in _header_nodes(node):
+            for child in ast.walk(header):
+                if isinstance(child, ast.Name):
+                    (self.loads if isinstance(child.ctx, ast.Load) else self.stores).add(child.id)
+                elif isinstance(child, ast.Call):
+                    self.calls.append(_call_parts(child.func))
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            self.stores.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                self.stores.add((alias.asname or alias.name).split('.')[0])
+
+    def lines(self):
+        if _is_compound(self.node):
+            # 复合语句只保留语句头所在的行
+            return range(self.node.lineno, max(self.node.lineno, _first_body_lineno(self.node) - 1) + 1)
+        return range(self.node.lineno, self.node.end_lineno + 1)
+
+
+def _keyword_clause(lines, field, body, previous_end):
+    """
+    else: / finally: 子句头的行号：从子句第一条语句所在行向前查找，不越过前一段语句体的末尾。
+    elif 对应的 orelse 是一条 If 语句，子句头就是它自己的语句头，返回空。
+    """
+    first = body[0].lineno
+    for lineno in range(first, previous_end, -1):
+        if lineno <= len(lines) and _CLAUSE_KEYWORDS[field].match(lines[lineno - 1]):
+            return (lineno,)
+    return ()
+
+
+def _clause_lines(first_lineno, body):
+    return tuple(range(first_lineno, max(first_lineno, body[0].lineno - 1) + 1))
+
+
+def _collect_statements(root, lines):
+    statements = []
+    stack = [(child, None, ()) for child in reversed(root.body)]
+    while stack:
+        node, parent, clause = stack.pop()
+        statement = _Statement(node, parent, clause)
+        statements.append(statement)
+        children = []
+        previous_end = node.lineno
+        for field in ('body', 'cases', 'handlers', 'orelse', 'finalbody'):
+            items = getattr(node, field, None) or []
+            if not items:
+                continue
+            clause = _keyword_clause(lines, field, items, previous_end) if field in _CLAUSE_KEYWORDS else ()
+            for item in items:
+                if isinstance(item, ast.ExceptHandler):
+                    # except 子句本身不是语句，取其中的语句，子句头为 except ...: 所在的行
+                    children.extend((child, _clause_lines(item.lineno, item.body)) for child in item.body)
+                elif isinstance(item, ast.match_case):
+                    children.extend((child, _clause_lines(item.pattern.lineno, item.body)) for child in item.body)
+                else:
+                    children.append((item, clause))
+            last = items[-1]
+            previous_end = (last.body[-1] if isinstance(last, (ast.ExceptHandler, ast.match_case)) else last).end_lineno
+        stack.extend((child, statement, clause) for child, clause in reversed(children) if isinstance(child, ast.stmt))
+    return statements
+
+
+def _quantum_imports(statements):
+    names = set()
+    for statement in statements:
+        node = statement.node
+        if isinstance(node, ast.ImportFrom) and _qiskit_module(node.module):
+            names.update(alias.asname or alias.name for alias in node.names if not alias.name.startswith('plot_'))
+        elif isinstance(node, ast.Import):
+            names.update((alias.asname or alias.name).split('.')[0] for alias in node.names
+                         if _qiskit_module(alias.name))
+    return names
+
+
+def _is_seed(statement, quantum_names):
+    node = statement.node
+    if isinstance(node, ast.ImportFrom):
+        return _qiskit_module(node.module)
+    if isinstance(node, ast.Import):
+        return any(_qiskit_module(alias.name) for alias in node.names)
+    if isinstance(node, ast.Return):
+        # 返回线路等量子对象的语句（如构造线路的函数）
+        return bool(statement.loads & quantum_names)
+    return any(parts and parts[0] in quantum_names and not _is_display(parts) for parts in statement.calls)
+
+
+def slice_relevant_code(code):
+    """
+    用 Ast_parser 解析代码，只保留与量子计算相关的语句及其依赖，丢弃绘图、文件读写等无关部分，
+    使同样的 block_size 容纳更多与缺陷相关的内容。
+
+    切片的起点为 qiskit 的 import、调用 qiskit 名称（或 QUANTUM_NAMES 中的名称）的语句，
+    以及对这些语句所赋值变量（线路、寄存器、后端、作业等）的方法调用；绘图和打印不作为起点。
+    然后反向加入被保留语句读取的名称的所有赋值语句（不区分作用域），以及被保留语句所在的复合语句头
+    和子句头（else:、except ...:、finally:、case ...:），不同分支中的语句不会被合并为顺序执行。
+
+    参数:
+        code (str): 代码内容。
+
+    返回:
+        str: 按原顺序保留的代码行；无法解析或找不到量子相关语句时返回原代码。
+    """
+    try:
+        root = Ast_parser().parser(code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return code
+
+    lines = code.split('\n')
+    statements = _collect_statements(root, lines)
+    quantum_names = QUANTUM_NAMES | _quantum_imports(statements)
+    kept = set()
+    # 正向传播：量子语句赋值的变量也是量子对象
+    changed = True
+    while changed:
+        changed = False
+        for i, statement in enumerate(statements):
+            if i not in kept and _is_seed(statement, quantum_names):
+                kept.add(i)
+                quantum_names |= statement.stores
+                changed = True
+    if not kept:
+        return code
+
+    definitions = {}
+    for i, statement in enumerate(statements):
+        for name in statement.stores:
+            definitions.setdefault(name, []).append(i)
+    index_of = {id(statement): i for i, statement in enumerate(statements)}
+    # 反向加入依赖和所在的复合语句头
+    pending = list(kept)
+    while pending:
+        statement = statements[pending.pop()]
+        required = [index_of[id(statement.parent)]] if statement.parent is not None else []
+        for name in statement.loads:
+            required.extend(definitions.get(name, ()))
+        for i in required:
+            if i not in kept:
+                kept.add(i)
+                pending.append(i)
+
+    line_numbers = sorted({lineno for i in kept for lineno in (*statements[i].lines(), *statements[i].clause)})
+    return '\n'.join(lines[lineno - 1] for lineno in line_numbers if lineno <= len(lines))
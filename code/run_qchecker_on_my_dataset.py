@@ -9,6 +9,7 @@ from ast_operations import Ast_parser
 from ast_operations import get_attributes, get_operations
 
 from qchecker import Qchecker
+from corpus_io import iter_records
 
 def read_jsonl(file_path):
     """
@@ -16,12 +17,10 @@ def read_jsonl(file_path):
     """
     data = []
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                record = json.loads(line.strip())
-                code = record.get("code")
-                label = record.get("label")
-                data.append({"code": code, "label": label})
+        for record in iter_records(file_path):
+            code = record.get("code")
+            label = record.get("label")
+            data.append({"code": code, "label": label})
     except FileNotFoundError:
         print(f"文件未找到：{file_path}")
     except json.JSONDecodeError:
@@ -124,6 +123,9 @@ for time in range(num_times):
         logger.info(f"Starting qchecker fold {fold + 1}/{num_folds}")
 
         file_path = f'../data{time}/{time}test.jsonl' # 用实际路径替换
+        if not os.path.exists(file_path):
+            # 基于列式语料库的行号划分
+            file_path = f'../data{time}/{time}test.ids.npz'
         metric_one = recompute_metrics(file_path)
 
         # 将每个折叠的指标添加到列表中
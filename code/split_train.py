@@ -1,14 +1,20 @@
 import json
 import os
 import random
-from collections import defaultdict
+
+import numpy as np
+
+from corpus_io import iter_records, save_id_split
+from corpus_store import CorpusStore
+from data_split import group_by_label, split_data_ids
 
 def split_train(input_jsonl, output_dir,time, test_ratio=0.2):
     """
     从输入的jsonl文件中读取数据，并按给定的比例划分数据集。
+    带 group 字段（pre_data --dedup）的近似重复文件整组划分到同一侧，避免训练集和测试集之间泄漏。
 
     参数:
-        input_jsonl (str): 输入的jsonl文件路径
+        input_jsonl (str): 输入的jsonl文件路径，或 pre_data 写出的分片目录 / 列式语料库
         output_dir (str): 输出文件夹路径，将在该文件夹中保存 data.jsonl, test.jsonl
         test_ratio (float): 测试集占比（默认为0.2）
 
@@ -19,17 +25,8 @@ def split_train(input_jsonl, output_dir,time, test_ratio=0.2):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
 
-    # 创建存储数据的字典，以label为键
-    data_by_label = defaultdict(list)
-
-    # 读取输入jsonl文件
-    with open(input_jsonl, 'r', encoding='utf-8') as f:
-        for line in f:
-            # 将每一行转换为JSON对象
-            json_obj = json.loads(line.strip())
-            label = json_obj['label']
-            # 将相同label的对象放在一起
-            data_by_label[label].append(json_obj)
+    # 读取输入jsonl文件（或分片目录、列式语料库），按label将近似重复组放在一起
+    groups_by_label = group_by_label(iter_records(input_jsonl))
 
     # 创建列表来存储train、valid、test数据
     train_data = []
@@ -37,18 +34,22 @@ def split_train(input_jsonl, output_dir,time, test_ratio=0.2):
     test_data = []
 
     # 按每个标签的数据进行划分
-    for label, items in data_by_label.items():
-        # 打乱数据顺序
-        random.shuffle(items)
+    for label, groups in groups_by_label.items():
+        # 打乱数据顺序（以组为单位）
+        random.shuffle(groups)
 
         # 计算每个数据集的大小
-        total = len(items)
+        total = sum(len(members) for members in groups)
         test_size = int(total * test_ratio)
-        train_size = total - test_size
 
-        # 划分数据集
-        test_data.extend(items[:test_size])
-        train_data.extend(items[test_size:])
+        # 划分数据集，前 test_size 条所在的组进入测试集
+        count = 0
+        for members in groups:
+            if count < test_size:
+                test_data.extend(members)
+            else:
+                train_data.extend(members)
+            count += len(members)
 
     # 定义保存的文件路径
     train_file = os.path.join(output_dir, f'{time}data.jsonl')
@@ -65,6 +66,64 @@ def split_train(input_jsonl, output_dir,time, test_ratio=0.2):
 
     print(f"Data split completed:\nTrain: {len(train_data)}\nTest: {len(test_data)}")
 
+def split_train_ids(labels, rng, test_ratio=0.2, groups=None):
+    """
+    与 split_train 相同的按标签分层、以近似重复组为单位的划分，但只返回列式语料库中的行号。
+
+    参数:
+        labels (np.ndarray): 整个语料库的标签数组
+        rng (np.random.Generator): 随机数生成器
+        test_ratio (float): 测试集占比（默认为0.2）
+        groups (np.ndarray, 可选): 每行所属组代表的行号，默认每行自成一组
+
+    返回:
+        tuple: (train_ids, test_ids)
+    """
+    if groups is None:
+        groups = np.arange(len(labels))
+    representatives = np.unique(groups)
+    sizes = np.bincount(groups, minlength=len(labels))
+
+    test_representatives = []
+    for label in np.unique(labels[representatives]):
+        label_representatives = rng.permutation(representatives[labels[representatives] == label])
+        label_sizes = sizes[label_representatives]
+        starts = np.cumsum(label_sizes) - label_sizes
+        test_size = int(label_sizes.sum() * test_ratio)
+        test_representatives.append(label_representatives[starts < test_size])
+
+    in_test = np.isin(groups, np.concatenate(test_representatives))
+    return np.flatnonzero(~in_test), np.flatnonzero(in_test)
+
+
+def write_index_splits(store_dir, output_root, num_times, num_folds=4, test_ratio=0.2, seed=42):
+    """
+    一次性为所有 num_times 生成训练/测试划分和 k 折划分，均以行号数组保存，
+    磁盘占用和耗时与代码大小无关。第 time 次划分使用种子 (seed, time)，可单独复现。
+
+    输出（以 time=0 为例）:
+        {output_root}/data0/0data.ids.npz, 0test.ids.npz
+        {output_root}/data0/fold/0train_fold{k}.ids.npz, 0valid_fold{k}.ids.npz
+    """
+    store = CorpusStore(store_dir)
+    labels = np.asarray(store.labels)
+    groups = np.asarray(store.groups)
+    for time in range(num_times):
+        rng = np.random.default_rng([seed, time])
+        prefix_time = os.path.join(output_root, f'data{time}')
+        fold_dir = os.path.join(prefix_time, 'fold')
+        os.makedirs(fold_dir, exist_ok=True)
+
+        train_ids, test_ids = split_train_ids(labels, rng, test_ratio=test_ratio, groups=groups)
+        save_id_split(os.path.join(prefix_time, f'{time}data.ids.npz'), train_ids, store_dir)
+        save_id_split(os.path.join(prefix_time, f'{time}test.ids.npz'), test_ids, store_dir)
+
+        for fold, (fold_train_ids, fold_valid_ids) in enumerate(split_data_ids(train_ids, labels, rng, num_folds, groups)):
+            save_id_split(os.path.join(fold_dir, f'{time}train_fold{fold}.ids.npz'), fold_train_ids, store_dir)
+            save_id_split(os.path.join(fold_dir, f'{time}valid_fold{fold}.ids.npz'), fold_valid_ids, store_dir)
+
+    print(f"Index splits written for {num_times} times x {num_folds} folds.")
+
 # 示例调用
 if __name__ == '__main__':
     input_jsonl = './data/Quantum/data.jsonl'  # 修改为实际输入文件路径
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+# 分词/特征构建方式变化时递增，旧缓存随之失效
+CACHE_VERSION = 1
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    由词表（含新增 token）、特殊 token 和 BPE merges 计算分词器指纹。
+    慢速与快速 RoBERTa 分词器产生相同的 id，因此二者的指纹相同、共享同一份缓存。
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode('utf-8'))
+    sha1.update(json.dumps(tokenizer.all_special_tokens, ensure_ascii=False).encode('utf-8'))
+    merges_file = os.path.join(tokenizer.name_or_path, 'merges.txt')
+    if os.path.isfile(merges_file):
+        with open(merges_file, 'rb') as f:
+            sha1.update(f.read())
+    else:
+        # 没有本地 merges 文件时退化为按名称区分
+        sha1.update(tokenizer.name_or_path.encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def record_hash(js):
+    """
+    记录的内容哈希：优先使用 pre_data 写出的 hash 字段，缺失时由代码计算。
+    """
+    return js.get('hash') or hashlib.sha1(js['code'].encode('utf-8')).hexdigest()
+
+
+class TokenCache(object):
+    """
+    按内容寻址的 token id 缓存，键为 (代码哈希, 分词器, block_size, 预处理方式)。
+    每种 (分词器, block_size, 预处理方式) 配置对应 cache_dir 下的一个 sqlite 文件，文件名由配置指纹决定，
+    分词器或 block_size 变化时自动使用新的文件，不会读到过期的 id。
+    同一段代码在所有 time、fold 和训练/验证/测试集中只分词一次。
+    """
+    def __init__(self, cache_dir, tokenizer, block_size, variant=''):
+        """
+        参数:
+            cache_dir (str): 缓存目录。
+            tokenizer: 用于构建特征的分词器。
+            block_size (int): 输入序列长度。
+            variant (str): 分词前对代码的预处理方式（如 'ast_slice:v2'），'' 表示完整代码。
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        key = f"{CACHE_VERSION}:{tokenizer_fingerprint(tokenizer)}:{block_size}"
+        if variant:
+            # 预处理后的 id 与完整代码的 id 不同，但代码哈希相同，必须分开存放
+            key += f":{variant}"
+        self.path = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + '.sqlite')
+        self.block_size = block_size
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS token_ids (hash TEXT PRIMARY KEY, ids BLOB NOT NULL)")
+
+    def get_many(self, hashes):
+        """
+        返回 {hash: input_ids(list)}，只包含已缓存的哈希。
+        """
+        found = {}
+        unique = list(set(hashes))
+        # sqlite 对单条语句的参数个数有限制，分批查询
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT hash, ids FROM token_ids WHERE hash IN ({','.join('?' * len(chunk))})", chunk)
+            for code_hash, ids in rows:
+                found[code_hash] = np.frombuffer(ids, dtype=np.int32).tolist()
+        return found
+
+    def put_many(self, items):
+        """
+        写入 (hash, input_ids) 序列。
+        """
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO token_ids (hash, ids) VALUES (?, ?)",
+            ((code_hash, np.asarray(ids, dtype=np.int32).tobytes()) for code_hash, ids in items))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()